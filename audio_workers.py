@@ -0,0 +1,485 @@
+"""Worker processes that mix and encode voice audio off the bot's GIL
+
+Normally every guild's MixedAudio mixes and encodes inside a discord audio
+player thread of the bot process, so all guilds share one interpreter lock.
+With audio workers enabled each guild is assigned to one of a pool of
+processes by the same formula discord uses to pick a guild's shard. The
+worker runs the guild's MixedAudio and writes the encoded packets into a
+shared memory ring, which the player thread drains without any
+serialisation. Join commands and idle notices travel over a pipe per
+worker, and the worker sends its mixing and encoding timings back over it
+every STATS_SECONDS so they show up in !stats and the metrics file. Gauges
+from a worker, such as its sound cache size, carry a worker label.
+
+A worker that dies is started again the next time one of its guilds needs
+a source. Sources it was playing end.
+
+Voice connections stay in the bot process, so this works the same with a
+plain Bot or an AutoShardedBot.
+
+Settings are read from the environment:
+    LLAMABOT_AUDIO_WORKERS       worker processes, 0 to mix in the bot
+                                 process (default: 0)
+    LLAMABOT_AUDIO_RING_FRAMES   20ms packets buffered per source (default: 10)
+"""
+
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import struct
+import threading
+import time
+import traceback
+
+import discord
+import numpy
+
+import mixed_audio
+import sound_cache
+import stats
+
+#the largest packet the discord encoder can produce for a frame
+MAX_PACKET = discord.opus.Encoder.FRAME_SIZE
+_LENGTH = struct.Struct('<H')
+SLOT_SIZE = _LENGTH.size + MAX_PACKET
+#written count, read count, finished flag, padded to a cache line
+HEADER_SIZE = 64
+#how long an idle worker waits for commands before checking its rings again
+POLL_SECONDS = 0.002
+#how often a worker sends its stats to the bot process
+STATS_SECONDS = 1.0
+
+
+class _PacketRing:
+    """Single producer, single consumer ring of packets in shared memory
+
+    The worker only ever advances the written count and the player thread
+    only the read count, so neither side needs a lock. A slot is filled
+    before the written count moves past it.
+    """
+    def __init__(self, memory, capacity):
+        self.__memory = memory
+        self.__capacity = capacity
+        self.__counts = numpy.ndarray((3,), dtype=numpy.uint64,
+                                      buffer=memory.buf)
+
+
+    @classmethod
+    def create(cls, capacity):
+        memory = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=HEADER_SIZE + capacity * SLOT_SIZE)
+        memory.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        return cls(memory, capacity)
+
+
+    @classmethod
+    def attach(cls, name, capacity):
+        return cls(multiprocessing.shared_memory.SharedMemory(name=name), capacity)
+
+
+    @property
+    def name(self):
+        return self.__memory.name
+
+
+    @property
+    def finished(self):
+        return bool(self.__counts[2])
+
+
+    def __len__(self):
+        return int(self.__counts[0] - self.__counts[1])
+
+
+    def has_space(self):
+        return len(self) < self.__capacity
+
+
+    def push(self, packet):
+        written = int(self.__counts[0])
+        offset = HEADER_SIZE + (written % self.__capacity) * SLOT_SIZE
+        _LENGTH.pack_into(self.__memory.buf, offset, len(packet))
+        self.__memory.buf[offset + _LENGTH.size:
+                          offset + _LENGTH.size + len(packet)] = packet
+        self.__counts[0] = written + 1
+
+
+    def pop(self):
+        """Return the next packet, or None if the ring is empty"""
+        read = int(self.__counts[1])
+        if read == int(self.__counts[0]):
+            return None
+        offset = HEADER_SIZE + (read % self.__capacity) * SLOT_SIZE
+        (length,) = _LENGTH.unpack_from(self.__memory.buf, offset)
+        start = offset + _LENGTH.size
+        packet = bytes(self.__memory.buf[start:start + length])
+        self.__counts[1] = read + 1
+        return packet
+
+
+    def skip(self):
+        """Drop every packet written so far"""
+        self.__counts[1] = self.__counts[0]
+
+
+    def finish(self):
+        self.__counts[2] = 1
+
+
+    def close(self, unlink=False):
+        #the numpy view has to go before the mapping can be closed
+        del self.__counts
+        self.__memory.close()
+        if unlink:
+            self.__memory.unlink()
+
+
+class _Worker:
+    """Bot process end of one audio worker process"""
+    def __init__(self, context, index):
+        self.index = index
+        self.alive = True
+        self.ready = threading.Event()
+        #source id -> RemoteSource
+        self.sources = {}
+        self.__send_lock = threading.Lock()
+
+        self.__conn, child_conn = context.Pipe()
+        self.__process = context.Process(target=_worker_main,
+                                         args=(child_conn,),
+                                         name='llamabot-audio-{}'.format(index),
+                                         daemon=True)
+        self.__process.start()
+        child_conn.close()
+
+        threading.Thread(target=self.__listen,
+                         name='llamabot-audio-listen-{}'.format(index),
+                         daemon=True).start()
+
+
+    def send(self, message):
+        with self.__send_lock:
+            self.__conn.send(message)
+
+
+    def stop(self, timeout=5):
+        try:
+            self.send(('stop',))
+        except (OSError, ValueError):
+            pass
+        self.__process.join(timeout)
+        if self.__process.is_alive():
+            self.__process.terminate()
+
+
+    def __listen(self):
+        try:
+            while True:
+                message = self.__conn.recv()
+                if message[0] == 'ready':
+                    self.ready.set()
+                elif message[0] == 'idle':
+                    _, source_id, adds = message
+                    source = self.sources.get(source_id)
+                    if source:
+                        source.worker_idle(adds)
+                elif message[0] == 'failed':
+                    source = self.sources.get(message[1])
+                    if source:
+                        source.worker_failed()
+                elif message[0] == 'stats':
+                    _, observations, gauges = message
+                    for name, value, labels in observations:
+                        stats.observe(name, value, **labels)
+                    for name, value, labels in gauges:
+                        stats.set_gauge(name, value, worker=self.index, **labels)
+        except (EOFError, OSError):
+            pass
+        finally:
+            #sources of a dead worker end instead of playing silence forever
+            self.alive = False
+            self.ready.set()
+            print('Audio worker {} exited'.format(self.index))
+
+
+class AudioWorkerPool:
+    def __init__(self, workers=None, ring_frames=None, start_timeout=60):
+        count = workers if workers is not None else int(
+            os.getenv('LLAMABOT_AUDIO_WORKERS', 0))
+        self.__ring_frames = ring_frames or int(
+            os.getenv('LLAMABOT_AUDIO_RING_FRAMES', 10))
+        self.__source_ids = itertools.count()
+        self.__start_timeout = start_timeout
+        self.__restart_lock = threading.Lock()
+
+        #spawned rather than forked, the bot process is full of threads
+        self.__context = multiprocessing.get_context('spawn')
+        self.__workers = [_Worker(self.__context, i) for i in range(count)]
+        for worker in self.__workers:
+            self.__wait_ready(worker)
+
+
+    def __wait_ready(self, worker):
+        #a source opened before its worker finished importing would stall
+        if not worker.ready.wait(self.__start_timeout) or not worker.alive:
+            raise RuntimeError('Audio worker {} did not start'.format(
+                                   worker.index))
+
+
+    @property
+    def enabled(self):
+        return bool(self.__workers)
+
+
+    def create_source(self, guild_id, linger=False, on_idle=None, **mixer_options):
+        """Start a MixedAudio for guild_id in its worker and return its RemoteSource
+
+        mixer_options are passed on to MixedAudio in the worker.
+        """
+        #discord's shard formula spreads guilds evenly and is stable per guild
+        worker = self.__live_worker((int(guild_id) >> 22) % len(self.__workers))
+        source_id = next(self.__source_ids)
+        ring = _PacketRing.create(self.__ring_frames)
+        source = RemoteSource(worker, source_id, ring, on_idle)
+        worker.sources[source_id] = source
+        worker.send(('open', source_id, ring.name, self.__ring_frames,
+                     dict(mixer_options, linger=linger, guild_id=guild_id)))
+        return source
+
+
+    def __live_worker(self, index):
+        """Return worker index, starting a new one if it has died"""
+        with self.__restart_lock:
+            worker = self.__workers[index]
+            if not worker.alive:
+                print('Restarting audio worker {}'.format(index))
+                worker.stop(timeout=1)
+                worker = _Worker(self.__context, index)
+                self.__workers[index] = worker
+                self.__wait_ready(worker)
+            return worker
+
+
+    def shutdown(self):
+        for worker in self.__workers:
+            worker.stop()
+
+
+class RemoteSource(discord.AudioSource):
+    """Player side of a MixedAudio running in an audio worker
+
+    Offers the same add_sound, is_idle and mark_join as MixedAudio so
+    VoiceCog can use either.
+    """
+    def __init__(self, worker, source_id, ring, on_idle=None):
+        self.__worker = worker
+        self.__id = source_id
+        self.__ring = ring
+        self.__on_idle = on_idle
+        self.__lock = threading.Lock()
+        self.__closed = False
+        #sounds sent to the worker, and how many it had when it went idle
+        self.__adds = 0
+        self.__idle_at = None
+        self.__failed = False
+        self.__join_started = None
+        self.__join_guild = None
+
+
+    def add_sound(self, sound_path):
+        with self.__lock:
+            if self.__closed:
+                return
+            if self.is_idle():
+                #drop silence buffered while idle so the sound starts at once
+                self.__ring.skip()
+            self.__adds += 1
+            self.__worker.send(('add', self.__id, str(sound_path), self.__adds))
+
+
+    def is_idle(self):
+        return self.__idle_at == self.__adds
+
+
+    def worker_idle(self, adds):
+        """Called from the listener thread when the worker's mixer runs dry"""
+        self.__idle_at = adds
+        if self.__on_idle and self.is_idle():
+            self.__on_idle()
+
+
+    def worker_failed(self):
+        """Called from the listener thread when the worker could not open the source"""
+        self.__failed = True
+
+
+    def mark_join(self, started, guild_id):
+        """Record join to first packet latency from a time.perf_counter() reading"""
+        self.__join_guild = guild_id
+        self.__join_started = started
+
+
+    def is_opus(self):
+        return True
+
+
+    def read(self):
+        with self.__lock:
+            if self.__closed:
+                return b''
+            packet = self.__ring.pop()
+            if packet is None:
+                if (self.__ring.finished or self.__failed or
+                        not self.__worker.alive):
+                    return b''
+                #the worker fell behind, keep the stream going
+                packet = mixed_audio.MixedAudio.SILENCE_PACKET
+
+        if self.__join_started is not None:
+            stats.observe('join_stage_ms', stats.since_ms(self.__join_started),
+                          stage='first_packet', guild=self.__join_guild)
+            self.__join_started = None
+        return packet
+
+
+    def cleanup(self):
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__worker.sources.pop(self.__id, None)
+            try:
+                self.__worker.send(('close', self.__id))
+            except (OSError, ValueError):
+                pass
+            self.__ring.close(unlink=True)
+
+
+class _StatsBuffer(stats.Registry):
+    """Registry of an audio worker, holding what it records until it is sent"""
+    def __init__(self):
+        super().__init__()
+        self.__lock = threading.Lock()
+        self.__observations = []
+        #(name, sorted label items) -> latest value
+        self.__gauges = {}
+
+
+    def observe(self, name, value_ms, **labels):
+        with self.__lock:
+            self.__observations.append((name, value_ms, labels))
+
+
+    def set_gauge(self, name, value, **labels):
+        with self.__lock:
+            self.__gauges[(name, tuple(sorted(labels.items())))] = value
+
+
+    def drain(self):
+        """Return and forget (observations, gauges) recorded since the last drain"""
+        with self.__lock:
+            observations, self.__observations = self.__observations, []
+            gauges, self.__gauges = self.__gauges, {}
+        return observations, [(name, value, dict(labels))
+                              for (name, labels), value in gauges.items()]
+
+
+class _WorkerSource:
+    __slots__ = ('mixer', 'ring', 'adds')
+
+    def __init__(self, mixer, ring):
+        self.mixer = mixer
+        self.ring = ring
+        self.adds = 0
+
+
+def _worker_main(conn):
+    """Entry point of an audio worker process"""
+    #everything the mixers record is sent to the bot process instead
+    stats_buffer = _StatsBuffer()
+    stats.REGISTRY = stats_buffer
+    next_stats = time.monotonic() + STATS_SECONDS
+    cache = sound_cache.SoundCache()
+    #source id -> _WorkerSource
+    sources = {}
+
+    def send_idle(source_id):
+        source = sources.get(source_id)
+        if source:
+            conn.send(('idle', source_id, source.adds))
+
+    try:
+        conn.send(('ready',))
+        while True:
+            #only block on the pipe while every ring is full or finished
+            busy = any(_can_produce(source) for source in sources.values())
+            timeout = 0 if busy else POLL_SECONDS
+            while conn.poll(timeout):
+                timeout = 0
+                message = conn.recv()
+                if message[0] == 'stop':
+                    return
+                _handle(message, sources, cache, conn, send_idle)
+
+            for source in list(sources.values()):
+                if not _can_produce(source):
+                    continue
+                packet = source.mixer.read()
+                if packet:
+                    source.ring.push(packet)
+                else:
+                    source.ring.finish()
+
+            if time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + STATS_SECONDS
+                observations, gauges = stats_buffer.drain()
+                if observations or gauges:
+                    conn.send(('stats', observations, gauges))
+
+    except (EOFError, OSError):
+        pass
+    finally:
+        for source in sources.values():
+            source.mixer.cleanup()
+            source.ring.close()
+
+
+def _can_produce(source):
+    #a source opened without sounds yet must not be read to its end
+    return (source.adds and not source.ring.finished and
+            source.ring.has_space())
+
+
+def _handle(message, sources, cache, conn, send_idle):
+    command, source_id = message[0], message[1]
+    try:
+        if command == 'open':
+            _, _, ring_name, capacity, mixer_options = message
+            on_idle = functools.partial(send_idle, source_id)
+            mixer = mixed_audio.MixedAudio(on_idle=on_idle, cache=cache,
+                                           **mixer_options)
+            sources[source_id] = _WorkerSource(mixer,
+                                               _PacketRing.attach(ring_name,
+                                                                  capacity))
+
+        elif command == 'add':
+            _, _, sound_path, adds = message
+            source = sources.get(source_id)
+            if source:
+                source.adds = adds
+                source.mixer.add_sound(sound_path)
+
+        elif command == 'close':
+            source = sources.pop(source_id, None)
+            if source:
+                source.mixer.cleanup()
+                source.ring.close()
+
+    except Exception as e:
+        traceback.print_exc()
+        print('Audio worker could not {} source {}: {}'.format(command,
+                                                               source_id, e))
+        if command == 'open':
+            conn.send(('failed', source_id))
@@ -0,0 +1,220 @@
+"""Offline benchmarks for the audio hot paths
+
+Everything runs on generated audio in a temporary directory, with no Discord
+connection and no network access. Results are written as JSON so runs from
+different revisions can be compared:
+
+    python benchmarks.py --output bench.json
+"""
+
+import argparse
+import json
+import math
+import pathlib
+import platform
+import subprocess
+import tempfile
+import time
+import types
+import wave
+
+import numpy
+
+import mixed_audio
+import pcm_sidecar
+import sound_index
+import sound_processing
+import voice_cog
+
+FRAME_BUDGET_MS = 20.0
+SAMPLE_RATE = pcm_sidecar.SAMPLE_RATE
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summarize(samples_ms):
+    return {
+        'count': len(samples_ms),
+        'p50_ms': percentile(samples_ms, 0.50),
+        'p99_ms': percentile(samples_ms, 0.99),
+        'max_ms': max(samples_ms) if samples_ms else 0.0,
+    }
+
+
+def generate_samples(seconds, seed):
+    """Interleaved stereo int16 noise shaped like a loud, normalised clip"""
+    rng = numpy.random.default_rng(seed)
+    values = int(seconds * SAMPLE_RATE) * pcm_sidecar.CHANNELS
+    return (rng.standard_normal(values) * 8000).clip(-32768, 32767).astype(numpy.int16)
+
+
+def write_sound(directory, name, seconds, seed):
+    """Create a sound as ingest leaves it: an mp3 path plus its PCM sidecar
+
+    The mp3 itself is only a placeholder; the sidecar is written after it so
+    playback maps the sidecar and never tries to decode the placeholder.
+    """
+    sound_path = pathlib.Path(directory) / '{}.mp3'.format(name)
+    sound_path.parent.mkdir(parents=True, exist_ok=True)
+    sound_path.touch()
+    pcm_sidecar.write_sidecar(sound_path,
+                              generate_samples(seconds, seed).tobytes())
+    return sound_path
+
+
+def bench_mix(work_dir, max_sounds, frames):
+    """Per-frame read() latency with 1..max_sounds sounds playing at once"""
+    paths = [write_sound(work_dir / 'mix', 'sound{}'.format(i), 6.0, i)
+             for i in range(max_sounds)]
+
+    results = {}
+    count = 1
+    while count <= max_sounds:
+        source = mixed_audio.MixedAudio(paths[0])
+        for path in paths[1:count]:
+            source.add_sound(path)
+
+        timings = []
+        for _ in range(frames):
+            start = time.perf_counter()
+            source.read()
+            timings.append((time.perf_counter() - start) * 1000)
+
+        summary = summarize(timings)
+        summary['within_budget'] = summary['p99_ms'] < FRAME_BUDGET_MS
+        results[str(count)] = summary
+        count *= 2
+    return results
+
+
+def bench_construction(work_dir, repeats):
+    """Time to build a MixedAudio and to add a second sound to it"""
+    first = write_sound(work_dir / 'construct', 'first', 6.0, 100)
+    second = write_sound(work_dir / 'construct', 'second', 6.0, 101)
+
+    construct = []
+    add = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        source = mixed_audio.MixedAudio(first)
+        construct.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        source.add_sound(second)
+        add.append((time.perf_counter() - start) * 1000)
+
+    return {'construct': summarize(construct), 'add_sound': summarize(add)}
+
+
+def bench_selection(work_dir, sound_counts, repeats):
+    """VoiceCog.__get_sound_path time as one member's sound list grows"""
+    member = types.SimpleNamespace(id=1)
+    guild = types.SimpleNamespace(id=2)
+    bot = types.SimpleNamespace(event=lambda f: f, user=None, loop=None)
+
+    results = {}
+    for sound_count in sound_counts:
+        index = sound_index.SoundIndex()
+        index.update_sounds(member.id, guild.id,
+                            {'sound{}'.format(i): ((i % 10) + 1,
+                                                   work_dir / 'sound{}.mp3'.format(i))
+                             for i in range(sound_count)})
+        cog = voice_cog.VoiceCog(bot, index, None)
+        get_sound_path = cog._VoiceCog__get_sound_path
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            get_sound_path(member, guild)
+            timings.append((time.perf_counter() - start) * 1000)
+        results[str(sound_count)] = summarize(timings)
+    return results
+
+
+def bench_processing(work_dir, seconds, repeats):
+    """Throughput of the sound processing SoundManagementCog runs per upload
+
+    Calls sound_processing.process_sound directly, which is what
+    SoundManagementCog.__process_sound hands to the worker pool.
+    """
+    input_path = work_dir / 'process' / 'input.wav'
+    input_path.parent.mkdir(parents=True, exist_ok=True)
+    with wave.open(str(input_path), 'wb') as f:
+        f.setnchannels(pcm_sidecar.CHANNELS)
+        f.setsampwidth(pcm_sidecar.SAMPLE_WIDTH)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(generate_samples(seconds, 200).tobytes())
+
+    timings = []
+    for i in range(repeats):
+        #separate blob stores so every run encodes instead of reusing a blob
+        blob_root = work_dir / 'process' / 'blobs{}'.format(i)
+        start = time.perf_counter()
+        sound_processing.process_sound(input_path, blob_root, 0)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    summary = summarize(timings)
+    summary['input_seconds'] = seconds
+    summary['audio_seconds_per_second'] = (
+        seconds / (summary['p50_ms'] / 1000) if summary['p50_ms'] else 0.0)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='bench_results.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--max-sounds', type=int, default=32,
+                        help='largest number of overlapping sounds to mix')
+    parser.add_argument('--frames', type=int, default=300,
+                        help='frames read per mixing run (300 = one 6s sound)')
+    parser.add_argument('--repeats', type=int, default=50,
+                        help='repetitions for construction and selection timings')
+    parser.add_argument('--skip-processing', action='store_true',
+                        help='skip the ffmpeg based processing benchmark')
+    args = parser.parse_args()
+
+    results = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'frame_budget_ms': FRAME_BUDGET_MS,
+    }
+
+    with tempfile.TemporaryDirectory(prefix='llamabot-bench-') as tmp:
+        work_dir = pathlib.Path(tmp)
+        results['mix_read'] = bench_mix(work_dir, args.max_sounds, args.frames)
+        results['construction'] = bench_construction(work_dir, args.repeats)
+        results['selection'] = bench_selection(work_dir,
+                                               [1, 10, 100, 1000, 10000],
+                                               args.repeats)
+        if not args.skip_processing:
+            results['processing'] = bench_processing(work_dir, 6.0,
+                                                     max(1, args.repeats // 10))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for count, summary in results['mix_read'].items():
+        print('{:>2} sounds: p50 {:.3f}ms p99 {:.3f}ms{}'.format(
+                  count, summary['p50_ms'], summary['p99_ms'],
+                  '' if summary['within_budget'] else ' OVER BUDGET'))
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
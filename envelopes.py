@@ -0,0 +1,102 @@
+"""Per-frame loudness envelopes stored next to each processed sound
+
+An envelope holds the peak and RMS sample value of every 20ms frame of a
+sound, about 4 bytes a frame. Ingest writes it alongside the PCM sidecar.
+The mixer reads it to skip frames that are silent and to bound the peak of
+overlapping sounds without scanning their samples.
+"""
+
+import os
+import pathlib
+import struct
+import tempfile
+
+import numpy
+
+import pcm_sidecar
+
+MAGIC = b'LLENV\x00\x00\x01'
+#sample frames in one 20ms opus frame
+SAMPLES_PER_FRAME = pcm_sidecar.SAMPLE_RATE // 50
+FRAME_VALUES = SAMPLES_PER_FRAME * pcm_sidecar.CHANNELS
+#frames peaking below -60dBFS are treated as silence
+SILENCE_PEAK = 33
+
+#magic, interleaved values per frame, number of frames
+_HEADER = struct.Struct('<8sII')
+
+
+def envelope_path(sound_path):
+    return pathlib.Path(sound_path).with_suffix('.envelope')
+
+
+def compute_envelope(samples):
+    """Return (peaks, rms) uint16 arrays for interleaved int16 samples
+
+    The last frame is zero padded, the same as the mixer and encoder do.
+    """
+    frames = -(-len(samples) // FRAME_VALUES)
+    padded = numpy.zeros(frames * FRAME_VALUES, dtype=numpy.int32)
+    padded[:len(samples)] = samples
+    padded = padded.reshape(frames, FRAME_VALUES)
+
+    peaks = numpy.abs(padded).max(axis=1, initial=0)
+    rms = numpy.sqrt(numpy.mean(padded.astype(numpy.float64) ** 2, axis=1))
+    return (numpy.minimum(peaks, 65535).astype(numpy.uint16),
+            numpy.rint(rms).astype(numpy.uint16))
+
+
+def write_envelope(sound_path, peaks, rms):
+    path = envelope_path(sound_path)
+    #unique so writers of the same envelope never share a temporary file
+    fd, tmp_path = tempfile.mkstemp(prefix=path.name + '.', suffix='.tmp',
+                                    dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, FRAME_VALUES, len(peaks)))
+            f.write(numpy.asarray(peaks, dtype='<u2').tobytes())
+            f.write(numpy.asarray(rms, dtype='<u2').tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        pathlib.Path(tmp_path).unlink(missing_ok=True)
+        raise
+    return path
+
+
+def delete_envelope(sound_path):
+    envelope_path(sound_path).unlink(missing_ok=True)
+
+
+def load_envelope(sound_path, samples=None):
+    """Return (peaks, rms) for sound_path
+
+    Sounds stored before envelopes existed, or whose envelope is stale, get
+    one computed from samples if given, otherwise None is returned.
+    """
+    sound_path = pathlib.Path(sound_path)
+    path = envelope_path(sound_path)
+    try:
+        if path.stat().st_mtime >= sound_path.stat().st_mtime:
+            with open(path, 'rb') as f:
+                data = f.read()
+            envelope = _parse(data)
+            if envelope is not None:
+                return envelope
+    except OSError:
+        pass
+
+    if samples is None:
+        return None
+    return compute_envelope(samples)
+
+
+def _parse(data):
+    if len(data) < _HEADER.size:
+        return None
+    magic, frame_values, count = _HEADER.unpack_from(data)
+    if (magic != MAGIC or frame_values != FRAME_VALUES or
+            len(data) != _HEADER.size + count * 4):
+        return None
+
+    values = numpy.frombuffer(data, dtype='<u2', offset=_HEADER.size)
+    return values[:count], values[count:]
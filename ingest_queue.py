@@ -0,0 +1,110 @@
+"""Admission control and private workspaces for sound ingestion
+
+Every add_sound request gets its own temporary directory under ./work, so
+requests no longer share a fixed file name and can run side by side. How many
+run at once is capped globally and per user; requests over the cap wait in a
+FIFO queue and are told their position.
+
+Limits are read from the environment:
+    LLAMABOT_INGEST_JOBS            concurrent ingests overall (default: cpu count)
+    LLAMABOT_INGEST_JOBS_PER_USER   concurrent ingests per user (default: 1)
+"""
+
+import asyncio
+import collections
+import contextlib
+import os
+import pathlib
+import shutil
+import tempfile
+import traceback
+
+
+class IngestQueue:
+    def __init__(self, max_jobs=None, max_jobs_per_user=None, work_root='./work'):
+        self.__max_jobs = max_jobs or int(os.getenv('LLAMABOT_INGEST_JOBS',
+                                                    os.cpu_count() or 1))
+        self.__max_jobs_per_user = max_jobs_per_user or int(
+            os.getenv('LLAMABOT_INGEST_JOBS_PER_USER', 1))
+        self.__work_root = pathlib.Path(work_root)
+
+        self.__running = 0
+        self.__running_per_user = collections.Counter()
+        #(user id, future) in arrival order
+        self.__waiting = collections.deque()
+
+
+    @contextlib.asynccontextmanager
+    async def workspace(self, user_id, on_queued=None):
+        """Wait for an ingest slot and yield a fresh directory to work in
+
+        on_queued is awaited with the 1-based queue position if the request
+        has to wait. The directory and everything in it is removed on exit,
+        whether the ingest succeeded or not.
+        """
+        await self.__acquire(user_id, on_queued)
+        try:
+            self.__work_root.mkdir(parents=True, exist_ok=True)
+            work_dir = pathlib.Path(tempfile.mkdtemp(prefix='ingest-',
+                                                     dir=self.__work_root))
+            try:
+                yield work_dir
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        finally:
+            self.__release(user_id)
+
+
+    async def __acquire(self, user_id, on_queued):
+        if self.__can_start(user_id):
+            self.__start(user_id)
+            return
+
+        waiter = (user_id, asyncio.get_running_loop().create_future())
+        self.__waiting.append(waiter)
+        try:
+            if on_queued:
+                try:
+                    await on_queued(len(self.__waiting))
+                except Exception as e:
+                    print('Could not report queue position: {}'.format(e))
+                    traceback.print_exc()
+            await waiter[1]
+        except BaseException:
+            if waiter[1].done() and not waiter[1].cancelled():
+                #the slot was granted just before we gave up on it, pass it on
+                self.__release(user_id)
+            elif waiter in self.__waiting:
+                self.__waiting.remove(waiter)
+            raise
+
+
+    def __can_start(self, user_id):
+        return (self.__running < self.__max_jobs and
+                self.__running_per_user[user_id] < self.__max_jobs_per_user)
+
+
+    def __start(self, user_id):
+        self.__running += 1
+        self.__running_per_user[user_id] += 1
+
+
+    def __release(self, user_id):
+        self.__running -= 1
+        self.__running_per_user[user_id] -= 1
+        if self.__running_per_user[user_id] <= 0:
+            del self.__running_per_user[user_id]
+
+        #hand freed slots to the oldest waiters that are allowed to run
+        for waiter in list(self.__waiting):
+            if self.__running >= self.__max_jobs:
+                break
+            waiting_user, future = waiter
+            if future.done():
+                #cancelled, its own cleanup has not run yet
+                self.__waiting.remove(waiter)
+                continue
+            if self.__can_start(waiting_user):
+                self.__waiting.remove(waiter)
+                self.__start(waiting_user)
+                future.set_result(None)
@@ -0,0 +1,101 @@
+"""Per-guild queue of intros waiting for the bot to reach their channel
+
+A guild's voice client can only be in one channel at a time, so joins in
+other channels wait here until the current source finishes. Channels are
+served in the order they were first queued, repeated joins to a queued
+channel are mixed together, and intros whose member has since left the
+channel or that waited past the deadline are dropped.
+
+The deadline is read from the environment:
+    LLAMABOT_INTRO_DEADLINE_SECONDS   max wait for a queued intro (default: 30)
+"""
+
+import asyncio
+import collections
+import os
+import time
+import traceback
+
+
+class _PendingIntro:
+    __slots__ = ('member', 'sound_path', 'queued_at')
+
+    def __init__(self, member, sound_path):
+        self.member = member
+        self.sound_path = sound_path
+        self.queued_at = time.monotonic()
+
+
+class IntroScheduler:
+    def __init__(self, play_intros, finish, max_age=None, locks=None):
+        """play_intros(guild, channel, sound_paths) and finish(guild) are
+        coroutines run on the event loop, the first when a queued channel is
+        next up and the second when a guild has nothing left to play.
+
+        locks maps a guild to the asyncio.Lock each advance holds. Share it
+        with anything else that moves the guild's voice client, such as
+        JoinBatcher, so neither acts on a client the other is changing.
+        """
+        self.__play_intros = play_intros
+        self.__finish = finish
+        self.__max_age = max_age or float(
+            os.getenv('LLAMABOT_INTRO_DEADLINE_SECONDS', 30))
+        #guild -> OrderedDict(channel -> [_PendingIntro]) in arrival order
+        self.__pending = {}
+        self.__locks = (locks if locks is not None else
+                        collections.defaultdict(asyncio.Lock))
+
+
+    def add(self, guild, channel, member, sound_path):
+        channels = self.__pending.setdefault(guild, collections.OrderedDict())
+        channels.setdefault(channel, []).append(_PendingIntro(member,
+                                                              sound_path))
+
+
+    def has_pending(self, guild):
+        return bool(self.__pending.get(guild))
+
+
+    def discard(self, guild):
+        self.__pending.pop(guild, None)
+
+
+    def source_finished(self, guild):
+        """Move the guild on to its next channel. Must run on the event loop
+
+        The audio thread hands this to loop.call_soon_threadsafe and returns
+        immediately instead of waiting for the move to happen.
+        """
+        asyncio.create_task(self.__advance(guild))
+
+
+    async def __advance(self, guild):
+        async with self.__locks[guild]:
+            try:
+                next_channel = self.__pop_next(guild)
+                if next_channel:
+                    await self.__play_intros(guild, *next_channel)
+                else:
+                    await self.__finish(guild)
+
+            except Exception as e:
+                traceback.print_exc()
+                print('Intro scheduling failed for {}: {}'.format(guild, e))
+
+
+    def __pop_next(self, guild):
+        """Return (channel, sound paths) for the oldest still relevant channel"""
+        channels = self.__pending.get(guild)
+        now = time.monotonic()
+
+        while channels:
+            channel, intros = channels.popitem(last=False)
+            sounds = [intro.sound_path for intro in intros
+                      if now - intro.queued_at <= self.__max_age and
+                         intro.member.voice and
+                         intro.member.voice.channel == channel]
+            if sounds:
+                return channel, sounds
+
+        self.__pending.pop(guild, None)
+        return None
@@ -0,0 +1,79 @@
+"""Debounce bursts of voice channel joins into one batch per channel
+
+When several members join a channel within the window they are handed over
+together, so their sounds are picked in one go and played from a single
+source after a single connect. The window starts at the first join of a
+burst and is not extended by later ones, so a steady trickle of joins
+cannot hold a batch back forever. A member only appears once per batch, at
+the channel they joined last, and batches for one guild are played one at
+a time so they never race each other to connect.
+
+The window is read from the environment:
+    LLAMABOT_JOIN_DEBOUNCE_MS   how long to collect joins (default: 300)
+"""
+
+import asyncio
+import collections
+import os
+import time
+import traceback
+
+
+class JoinBatcher:
+    def __init__(self, play_joins, window_ms=None, locks=None):
+        """play_joins(guild, channel, members, started) is a coroutine run on
+        the event loop with the members of a batch in join order and the
+        time.perf_counter() reading of the first join.
+
+        locks maps a guild to the asyncio.Lock each batch is played under,
+        see IntroScheduler.
+        """
+        self.__play_joins = play_joins
+        window_ms = window_ms if window_ms is not None else float(
+            os.getenv('LLAMABOT_JOIN_DEBOUNCE_MS', 300))
+        self.__window = window_ms / 1000
+        #(guild, channel) -> OrderedDict(member -> None) in join order
+        self.__pending = {}
+        #(guild, channel) -> perf_counter reading of the first join
+        self.__started = {}
+        self.__locks = (locks if locks is not None else
+                        collections.defaultdict(asyncio.Lock))
+
+
+    def add(self, guild, channel, member):
+        """Queue a join. Must run on the event loop"""
+        #a member hopping channels only gets a sound in the last one
+        self.discard(guild, member)
+
+        key = (guild, channel)
+        if key not in self.__pending:
+            self.__pending[key] = collections.OrderedDict()
+            self.__started[key] = time.perf_counter()
+            asyncio.get_running_loop().call_later(self.__window,
+                                                  self.__flush,
+                                                  key)
+        self.__pending[key][member] = None
+
+
+    def discard(self, guild, member):
+        """Forget a member's pending join in any channel of guild"""
+        for (pending_guild, _), members in self.__pending.items():
+            if pending_guild == guild:
+                members.pop(member, None)
+
+
+    def __flush(self, key):
+        members = list(self.__pending.pop(key))
+        started = self.__started.pop(key)
+        if members:
+            asyncio.create_task(self.__play(key, members, started))
+
+
+    async def __play(self, key, members, started):
+        guild, channel = key
+        async with self.__locks[guild]:
+            try:
+                await self.__play_joins(guild, channel, members, started)
+            except Exception as e:
+                traceback.print_exc()
+                print('Could not play joins for {}: {}'.format(channel, e))
@@ -1,23 +1,101 @@
 
+#taken before anything else is imported, for the import phase timing
+import time
+STARTED = time.perf_counter()
+
 import asyncio
 import logging
 import os
+import traceback
 
 import discord
 from discord.ext import commands
 import dotenv
 
+import audio_workers
+import sound_catalog
+import sound_index
 import sound_management_cog
 import meta_cog
+import stats
 import voice_cog
+import worker_pool
+
+IMPORTED = time.perf_counter()
 
 
 async def bot_loop(bot, token):
-    async with bot:
-        await bot.add_cog(sound_management_cog.SoundManagementCog(bot))
-        await bot.add_cog(meta_cog.MetaCog(bot))
-        await bot.add_cog(voice_cog.VoiceCog(bot))
-        await bot.start(token)
+    stats.observe('startup_ms', (IMPORTED - STARTED) * 1000, phase='import')
+
+    catalog = sound_catalog.SoundCatalog()
+    #filled in once the bot is ready, joins before then wait for it
+    index = sound_index.SoundIndex(loaded=False)
+    workers = worker_pool.WorkerPool()
+    audio = audio_workers.AudioWorkerPool()
+    voice = voice_cog.VoiceCog(bot, index, workers, audio)
+    preload_task = None
+
+    async def on_ready():
+        nonlocal preload_task
+        #on_ready fires again after every reconnect
+        if preload_task:
+            return
+        stats.observe('startup_ms', stats.since_ms(STARTED), phase='ready')
+        preload_task = asyncio.create_task(preload(catalog, index, voice, workers))
+
+    bot.add_listener(on_ready)
+
+    try:
+        async with bot:
+            await bot.add_cog(sound_management_cog.SoundManagementCog(bot,
+                                                                      catalog,
+                                                                      index,
+                                                                      workers))
+            await bot.add_cog(meta_cog.MetaCog(bot))
+            await bot.add_cog(voice)
+            with stats.timed('startup_ms', phase='login'):
+                await bot.login(token)
+            await bot.connect()
+    finally:
+        audio.shutdown()
+        workers.shutdown()
+        catalog.close()
+
+
+async def preload(catalog, index, voice, workers):
+    """Load the sound index, then warm the sound cache, off the startup path"""
+    started = time.perf_counter()
+    try:
+        if catalog.is_empty():
+            #first start since sounds moved into the catalog, the tree is
+            #scanned off the loop and joins wait for the index meanwhile
+            entries = await workers.run_io(sound_catalog.scan_tree)
+            #sounds added during the scan are newer than the tree's
+            entries = [entry for entry in entries
+                       if not catalog.get_sound(entry.owner_id, entry.guild_id,
+                                                entry.name)]
+            catalog.add_sounds(entries)
+            stats.observe('startup_ms', stats.since_ms(started), phase='import_tree')
+            print('Imported {} existing sounds'.format(len(entries)))
+
+        #the catalog's connection is only ever used from the event loop, and
+        #this is one quick table scan
+        entries = list(catalog.selection_entries())
+        index.add_entries(entries)
+        stats.observe('startup_ms', stats.since_ms(started), phase='index')
+
+        await voice.preload_sounds(sorted({path for *_, path in entries}))
+        stats.observe('startup_ms', stats.since_ms(started), phase='preload')
+        print('Preloaded {} sounds in {:.0f}ms'.format(len(entries),
+                                                       stats.since_ms(started)))
+
+    except Exception as e:
+        traceback.print_exc()
+        print('Could not preload sounds: {}'.format(e))
+    finally:
+        #never leave joins waiting on an index that will not load
+        if not index.loaded:
+            index.add_entries([])
 
 
 def main():
@@ -33,7 +111,12 @@ def main():
     intents.members = True
     intents.message_content = True
     intents.voice_states = True
-    bot = commands.Bot(
+    #let discord pick the shard count once the bot is in enough guilds
+    if os.getenv('LLAMABOT_SHARDED') == '1':
+        bot_class = commands.AutoShardedBot
+    else:
+        bot_class = commands.Bot
+    bot = bot_class(
         command_prefix=commands.when_mentioned_or('!'),
         intents=intents,
     )
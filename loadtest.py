@@ -0,0 +1,573 @@
+"""Offline load test of the voice and sound management cogs
+
+Runs the real VoiceCog, and optionally SoundManagementCog, against a fake
+gateway: generated guilds, channels and members, voice state events fed
+straight to the cog's handler, and fake voice clients whose player threads
+call AudioSource.read() at real 20ms pacing just like discord's AudioPlayer.
+No Discord connection or network access is needed.
+
+A run replays join storms, every member of every guild joining within a
+short spread, and waits for the bot to play them out. It reports join to
+first packet latency, missed frame deadlines, event loop lag and memory
+use as JSON. Thresholds turn it into a pass/fail check for CI:
+
+    python loadtest.py --guilds 50 --members 10 --max-join-p99-ms 1000
+
+Everything is created in a temporary directory the test runs in, and the
+bot's own LLAMABOT_* settings apply as usual.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+import types
+import wave
+
+import benchmarks
+import mixed_audio
+import pcm_sidecar
+import sound_index
+import stats
+import voice_cog
+import worker_pool
+
+FRAME_SECONDS = 0.02
+#how often the event loop lag probe wakes up
+LAG_PROBE_SECONDS = 0.01
+
+
+class FakeBot:
+    """Just enough of commands.Bot for the cogs: event registration and user"""
+    def __init__(self):
+        self.user = FakeMember(0, None, bot=True)
+        self.loop = None
+        self.handlers = {}
+
+
+    def event(self, coro):
+        self.handlers[coro.__name__] = coro
+        return coro
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, bot=False):
+        self.id = member_id
+        self.guild = guild
+        self.bot = bot
+        self.name = 'member{}'.format(member_id)
+        self.voice = None
+        self.mutual_guilds = [guild] if guild else []
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild, harness):
+        self.id = channel_id
+        self.guild = guild
+        self.name = 'channel{}'.format(channel_id)
+        self.members = []
+        self.__harness = harness
+
+
+    async def connect(self):
+        await asyncio.sleep(self.__harness.handshake_seconds())
+        voice_client = FakeVoiceClient(self, self.__harness)
+        self.guild.voice_client = voice_client
+        self.__harness.connects += 1
+        return voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id, channels, harness):
+        self.id = guild_id
+        self.name = 'guild{}'.format(guild_id)
+        self.voice_client = None
+        self.channels = [FakeChannel(guild_id * 100 + i, self, harness)
+                         for i in range(channels)]
+        self.members = []
+
+
+class FakeVoiceClient:
+    """A voice client whose player thread paces read() like discord's AudioPlayer"""
+    def __init__(self, channel, harness):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self.__harness = harness
+        self.__after = None
+        self.__thread = None
+        self.__stopped = threading.Event()
+        self.__resumed = threading.Event()
+        self.__resumed.set()
+
+
+    def play(self, source, after=None):
+        if self.is_playing():
+            raise RuntimeError('Already playing audio')
+        self.source = source
+        self.__after = after
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='fake-audio-player',
+                                         daemon=True)
+        self.__thread.start()
+
+
+    def is_playing(self):
+        return (self.__thread is not None and self.__thread.is_alive() and
+                self.__resumed.is_set() and not self.__stopped.is_set())
+
+
+    def is_paused(self):
+        return self.__thread is not None and not self.__resumed.is_set()
+
+
+    def pause(self):
+        self.__resumed.clear()
+
+
+    def resume(self):
+        self.__resumed.set()
+
+
+    def stop(self):
+        self.__stopped.set()
+        self.__resumed.set()
+
+
+    async def move_to(self, channel):
+        await asyncio.sleep(self.__harness.handshake_seconds())
+        self.channel = channel
+
+
+    async def disconnect(self, force=False):
+        self.stop()
+        if self.__thread and self.__thread is not threading.current_thread():
+            await asyncio.to_thread(self.__thread.join)
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+
+    def __run(self):
+        error = None
+        try:
+            loops = 0
+            start = time.perf_counter()
+            while not self.__stopped.is_set():
+                if not self.__resumed.is_set():
+                    self.__resumed.wait()
+                    #discord restarts its pacing after a pause
+                    loops = 0
+                    start = time.perf_counter()
+                    continue
+
+                read_started = time.perf_counter()
+                packet = self.source.read()
+                finished = time.perf_counter()
+                if not packet:
+                    #discord's player counts as stopped before after runs
+                    self.__stopped.set()
+                    break
+                self.__harness.packet_sent(self.guild, packet,
+                                           finished - read_started,
+                                           finished - (start + FRAME_SECONDS * loops))
+
+                loops += 1
+                delay = start + FRAME_SECONDS * loops - time.perf_counter()
+                if delay > 0:
+                    self.__stopped.wait(delay)
+        except Exception as e:
+            error = e
+
+        self.__resumed.set()
+        if self.__after:
+            self.__after(error)
+        self.source.cleanup()
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.connects = 0
+        self.packets = 0
+        self.missed_frames = 0
+        self.__lock = threading.Lock()
+        self.__read_ms = []
+        #guild id -> perf_counter of the first join of the current storm,
+        #until the guild's first packet
+        self.__storm_started = {}
+        #guilds that have had a join in the current storm
+        self.__storm_guilds = set()
+        self.__join_ms = []
+        self.__loop_lag_ms = []
+        self.__random = random.Random(args.seed)
+
+
+    def handshake_seconds(self):
+        return self.__random.uniform(0.5, 1.5) * self.args.connect_ms / 1000
+
+
+    def packet_sent(self, guild, packet, read_seconds, lateness_seconds):
+        """Called from a player thread for every packet read"""
+        with self.__lock:
+            self.packets += 1
+            self.__read_ms.append(read_seconds * 1000)
+            #the packet was due a whole frame ago
+            if lateness_seconds > FRAME_SECONDS:
+                self.missed_frames += 1
+            if packet != mixed_audio.MixedAudio.SILENCE_PACKET:
+                started = self.__storm_started.pop(guild.id, None)
+                if started is not None:
+                    self.__join_ms.append((time.perf_counter() - started) * 1000)
+
+
+    def new_storm(self):
+        with self.__lock:
+            self.__storm_guilds.clear()
+
+
+    def storm_unplayed(self):
+        """Whether any guild joined in this storm has yet to send a packet"""
+        with self.__lock:
+            return bool(self.__storm_started)
+
+
+    def member_joining(self, guild):
+        #only a guild's first join in a storm is timed to its first packet
+        with self.__lock:
+            if guild.id not in self.__storm_guilds:
+                self.__storm_guilds.add(guild.id)
+                self.__storm_started[guild.id] = time.perf_counter()
+
+
+    async def probe_loop_lag(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(LAG_PROBE_SECONDS)
+            self.__loop_lag_ms.append(
+                max(0.0, (time.perf_counter() - started - LAG_PROBE_SECONDS) * 1000))
+
+
+    def report(self):
+        with self.__lock:
+            return {
+                'guild_storms_played': len(self.__join_ms),
+                'guild_storms_unplayed': len(self.__storm_started),
+                'join_to_first_packet': benchmarks.summarize(self.__join_ms),
+                'read': benchmarks.summarize(self.__read_ms),
+                'packets': self.packets,
+                'missed_frames': self.missed_frames,
+                'connects': self.connects,
+                'event_loop_lag': benchmarks.summarize(self.__loop_lag_ms),
+            }
+
+
+def build_world(args, harness, work_dir):
+    """Generate guilds, members and their sounds, returning (guilds, index)"""
+    sounds = [benchmarks.write_sound(work_dir / 'sounds', 'sound{}'.format(i),
+                                     args.sound_seconds, i)
+              for i in range(args.distinct_sounds)]
+
+    rng = random.Random(args.seed)
+    index = sound_index.SoundIndex()
+    guilds = []
+    for g in range(args.guilds):
+        #spread ids over the snowflake range so shard formulas see variety
+        guild = FakeGuild((g + 1) << 22 | g, args.channels, harness)
+        for m in range(args.members):
+            member = FakeMember(g * args.members + m + 1, guild)
+            guild.members.append(member)
+            index.update_sounds(member.id, guild.id,
+                                {'s{}'.format(i): (rng.randint(1, 5), path)
+                                 for i, path in enumerate(
+                                     rng.sample(sounds, min(3, len(sounds))))})
+        guilds.append(guild)
+    return guilds, index
+
+
+async def dispatch_voice_state(bot, member, channel):
+    """Update a member's voice state and deliver it like the gateway would"""
+    before = types.SimpleNamespace(channel=member.voice.channel if member.voice else None)
+    if before.channel:
+        before.channel.members.remove(member)
+    member.voice = types.SimpleNamespace(channel=channel) if channel else None
+    if channel:
+        channel.members.append(member)
+    after = types.SimpleNamespace(channel=channel)
+    await bot.handlers['on_voice_state_update'](member, before, after)
+
+
+async def join_storm(bot, harness, guilds, spread_seconds, rng):
+    async def join(member, channel, delay):
+        await asyncio.sleep(delay)
+        harness.member_joining(member.guild)
+        await dispatch_voice_state(bot, member, channel)
+
+    harness.new_storm()
+    joins = []
+    for guild in guilds:
+        for member in guild.members:
+            channel = rng.choice(guild.channels)
+            joins.append(join(member, channel, rng.uniform(0, spread_seconds)))
+    await asyncio.gather(*joins)
+
+
+async def leave_all(bot, guilds):
+    for guild in guilds:
+        for member in guild.members:
+            if member.voice:
+                await dispatch_voice_state(bot, member, None)
+
+
+async def wait_until_quiet(guilds, timeout, harness=None):
+    """Wait for every guild to finish playing: disconnected or lingering paused
+
+    Given the harness, first wait for every guild joined in the storm to have
+    played, since a guild whose batch or connect is still pending has no
+    voice client yet and would look quiet.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if ((harness is None or not harness.storm_unplayed()) and
+                all(guild.voice_client is None or guild.voice_client.is_paused()
+                    for guild in guilds)):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+class FakeAttachment:
+    def __init__(self, filename, seconds, seed):
+        self.filename = filename
+        self.content_type = 'audio/wav'
+        self.__seconds = seconds
+        self.__seed = seed
+
+
+    async def save(self, path):
+        with wave.open(str(path), 'wb') as f:
+            f.setnchannels(pcm_sidecar.CHANNELS)
+            f.setsampwidth(pcm_sidecar.SAMPLE_WIDTH)
+            f.setframerate(pcm_sidecar.SAMPLE_RATE)
+            f.writeframes(benchmarks.generate_samples(self.__seconds,
+                                                      self.__seed).tobytes())
+
+
+class FakeContext:
+    def __init__(self, author, guild):
+        self.author = author
+        self.guild = guild
+        self.replies = []
+
+
+    async def reply(self, content=None, file=None):
+        self.replies.append(content)
+
+
+    def typing(self):
+        return _NoTyping()
+
+
+class _NoTyping:
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+async def ingest_storm(cog, guilds, count, seconds):
+    """Run count add_sound_attached commands at once, returning their timings"""
+    async def add(i):
+        guild = guilds[i % len(guilds)]
+        member = guild.members[i % len(guild.members)]
+        ctx = FakeContext(member, guild)
+        started = time.perf_counter()
+        await cog.add_sound_attached.callback(cog, ctx, 'upload{}'.format(i), '1',
+                                              FakeAttachment('upload.wav',
+                                                             seconds, 1000 + i),
+                                              None)
+        ok = any(reply and reply.startswith('Successfully') for reply in ctx.replies)
+        return (time.perf_counter() - started) * 1000, ok
+
+    results = await asyncio.gather(*(add(i) for i in range(count)))
+    summary = benchmarks.summarize([ms for ms, _ in results])
+    summary['failed'] = sum(1 for _, ok in results if not ok)
+    return summary
+
+
+def rss_mb():
+    """Current resident set size, falling back to the peak off Linux"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args, work_dir):
+    harness = Harness(args)
+    bot = FakeBot()
+    bot.loop = asyncio.get_running_loop()
+    rng = random.Random(args.seed)
+
+    guilds, index = build_world(args, harness, work_dir)
+    workers = worker_pool.WorkerPool()
+    audio = None
+    if args.audio_workers:
+        import audio_workers
+        audio = audio_workers.AudioWorkerPool(workers=args.audio_workers)
+
+    results = {'rss_start_mb': rss_mb()}
+    lag_task = asyncio.create_task(harness.probe_loop_lag())
+    try:
+        voice_cog.VoiceCog(bot, index, workers, audio)
+
+        storms = []
+        for _ in range(args.storms):
+            started = time.perf_counter()
+            await join_storm(bot, harness, guilds, args.spread_ms / 1000, rng)
+            quiet = await wait_until_quiet(guilds, args.timeout, harness)
+            storms.append({'seconds': time.perf_counter() - started,
+                           'completed': quiet})
+            await leave_all(bot, guilds)
+            await wait_until_quiet(guilds, args.timeout)
+        results['storms'] = storms
+        results['rss_after_storms_mb'] = rss_mb()
+
+        if args.ingest:
+            import sound_catalog
+            import sound_management_cog
+            catalog = sound_catalog.SoundCatalog('./sounds')
+            try:
+                cog = sound_management_cog.SoundManagementCog(bot, catalog,
+                                                              index, workers)
+                results['ingest'] = await ingest_storm(cog, guilds, args.ingest,
+                                                       args.sound_seconds)
+            finally:
+                catalog.close()
+
+    finally:
+        lag_task.cancel()
+        for guild in guilds:
+            if guild.voice_client:
+                await guild.voice_client.disconnect(force=True)
+        if audio:
+            audio.shutdown()
+        workers.shutdown()
+
+    results.update(harness.report())
+    results['rss_peak_mb'] = peak_rss_mb()
+    results['first_packet_stage'] = first_packet_stage()
+    return results
+
+
+def first_packet_stage():
+    """The bot's own join_stage_ms first_packet timings across every guild"""
+    values = []
+    for name, labels, histogram in stats.REGISTRY.items():
+        if name == 'join_stage_ms' and labels.get('stage') == 'first_packet':
+            values.extend(histogram.quantile(q) or 0.0 for q in (0.5, 0.99))
+    return {'guilds_reporting': len(values) // 2,
+            'worst_p99_ms': max(values) if values else 0.0}
+
+
+def check_thresholds(args, results):
+    failures = []
+    p99 = results['join_to_first_packet']['p99_ms']
+    if args.max_join_p99_ms is not None and p99 > args.max_join_p99_ms:
+        failures.append('join to first packet p99 {:.1f}ms over {:.1f}ms'.format(
+                            p99, args.max_join_p99_ms))
+    if (args.max_missed_frames is not None and
+            results['missed_frames'] > args.max_missed_frames):
+        failures.append('{} missed frames over {}'.format(results['missed_frames'],
+                                                          args.max_missed_frames))
+    lag = results['event_loop_lag']['p99_ms']
+    if args.max_loop_lag_ms is not None and lag > args.max_loop_lag_ms:
+        failures.append('event loop lag p99 {:.1f}ms over {:.1f}ms'.format(
+                            lag, args.max_loop_lag_ms))
+    if (results['guild_storms_unplayed'] or
+            not all(storm['completed'] for storm in results['storms'])):
+        failures.append('{} guild storms never played'.format(
+                            results['guild_storms_unplayed']))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='loadtest_results.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--members', type=int, default=8,
+                        help='members per guild, all of whom join in each storm')
+    parser.add_argument('--channels', type=int, default=1,
+                        help='voice channels per guild members spread over')
+    parser.add_argument('--storms', type=int, default=2)
+    parser.add_argument('--spread-ms', type=float, default=500,
+                        help='window each storm\'s joins are spread over')
+    parser.add_argument('--connect-ms', type=float, default=150,
+                        help='mean fake voice handshake time')
+    parser.add_argument('--distinct-sounds', type=int, default=16,
+                        help='generated sounds shared out between members')
+    parser.add_argument('--sound-seconds', type=float, default=2.0)
+    parser.add_argument('--audio-workers', type=int, default=0,
+                        help='mix in this many worker processes')
+    parser.add_argument('--ingest', type=int, default=0,
+                        help='concurrent uploads to run after the storms, needs ffmpeg')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for a storm to play out')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-join-p99-ms', type=float)
+    parser.add_argument('--max-missed-frames', type=int)
+    parser.add_argument('--max-loop-lag-ms', type=float)
+    args = parser.parse_args()
+
+    output = pathlib.Path(args.output).resolve()
+    results = {
+        'revision': benchmarks.git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'config': vars(args),
+    }
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='llamabot-load-') as tmp:
+        #the cogs keep their files relative to the working directory
+        os.chdir(tmp)
+        try:
+            results.update(asyncio.run(run(args, pathlib.Path(tmp))))
+        finally:
+            os.chdir(cwd)
+
+    failures = check_thresholds(args, results)
+    results['failures'] = failures
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    join = results['join_to_first_packet']
+    print('{} guild storms: first packet p50 {:.1f}ms p99 {:.1f}ms, {} missed frames, '
+          'loop lag p99 {:.1f}ms, peak rss {:.0f}MB'.format(
+              results['guild_storms_played'], join['p50_ms'], join['p99_ms'],
+              results['missed_frames'], results['event_loop_lag']['p99_ms'],
+              results['rss_peak_mb']))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    print('Results written to {}'.format(output))
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
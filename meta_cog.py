@@ -1,10 +1,15 @@
 
+import asyncio
+
 from discord.ext import commands
 
+import stats
+
 
 class MetaCog(commands.Cog):
     def __init__(self, bot):
         self.__bot = bot
+        self.__metrics_task = None
 
         @bot.event
         async def on_ready():
@@ -12,3 +17,56 @@ class MetaCog(commands.Cog):
 
             print(f'Logged in as {bot.user} (ID: {bot.user.id})')
             print('------')
+
+
+    async def cog_load(self):
+        self.__metrics_task = asyncio.create_task(stats.write_periodically())
+
+
+    async def cog_unload(self):
+        if self.__metrics_task:
+            self.__metrics_task.cancel()
+
+    #########
+    # stats #
+    #########
+    @commands.command(
+        help="""This command shows recent timings of the join and sound processing pipelines in milliseconds.
+
+        Join timings are broken into stages: picking a sound, connecting to voice, loading the sound, and the total time until the first audio packet. In a server only that server's join timings are shown. Startup phases are listed as startup_ms. Current cache sizes and hit rates, and each server's read-ahead underruns and buffered frames, sounds playing, queued and dropped at the voice cap, and limiter gain, are listed below the timings.""",
+        brief="""No arguments""")
+    async def stats(self, ctx):
+        lines = ['{:<40} {:>7} {:>9} {:>9}'.format('timing', 'count', 'p50', 'p99')]
+        for name, labels, histogram in stats.REGISTRY.items():
+            guild = labels.pop('guild', None)
+            if ctx.guild and guild is not None and guild != str(ctx.guild.id):
+                continue
+            if guild is not None and not ctx.guild:
+                labels['guild'] = guild
+
+            label = ' '.join([name] + ['{}={}'.format(k, v)
+                                       for k, v in sorted(labels.items())])
+            lines.append('{:<40} {:>7} {:>9.2f} {:>9.2f}'.format(
+                             label[:40],
+                             histogram.count,
+                             histogram.quantile(0.5) or 0.0,
+                             histogram.quantile(0.99) or 0.0))
+
+        for name, labels, value in stats.REGISTRY.gauges():
+            guild = labels.pop('guild', None)
+            if ctx.guild and guild is not None and guild != str(ctx.guild.id):
+                continue
+            if guild is not None and not ctx.guild:
+                labels['guild'] = guild
+
+            label = ' '.join([name] + ['{}={}'.format(k, v)
+                                       for k, v in sorted(labels.items())])
+            lines.append('{:<40} {:>27.4g}'.format(label[:40], value))
+
+        if len(lines) == 1:
+            await ctx.reply('No timings recorded yet')
+            return
+
+        #stay under discord's message length limit
+        text = '\n'.join(lines)[:1900]
+        await ctx.reply('```\n{}\n```'.format(text))
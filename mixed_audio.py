@@ -1,33 +1,264 @@
 
+import collections
+import threading
+import time
 import traceback
 
 import discord
-import pydub
+import numpy
+
+import envelopes
+import opus_packets
+import pcm_sidecar
+import stats
+
+
+class _ActiveSound:
+    """Interleaved int16 samples of one playing sound plus a read cursor
+
+    Advancing the cursor replaces slicing the remainder of the sound off every
+    frame, so reading a clip is linear in its length instead of quadratic.
+    peaks is the sound's envelope of 20ms frame peaks, or None without one.
+    """
+    __slots__ = ('samples', 'cursor', 'peaks')
+
+    def __init__(self, samples, peaks=None):
+        self.samples = samples
+        self.cursor = 0
+        #an envelope that does not match the samples is no use
+        frames = -(-len(samples) // envelopes.FRAME_VALUES)
+        self.peaks = peaks if peaks is not None and len(peaks) == frames else None
+
+
+    def remaining(self):
+        return len(self.samples) - self.cursor
 
 
 class MixedAudio(discord.AudioSource):
-    def __init__(self, sound_path):
-        self.__active_sounds = [
-            pydub.AudioSegment.from_file(sound_path)
-        ]
-
-        self.__encoder = discord.opus.Encoder(
-            application='audio',
-            bitrate=128,
-            fec=True,
-            expected_packet_loss=0.15,
-            bandwidth='full',
-            signal_type='auto',
-        )
-        pass
+    SAMPLE_RATE = discord.opus.Encoder.SAMPLING_RATE
+    CHANNELS = discord.opus.Encoder.CHANNELS
+    SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+    #interleaved int16 values in one 20ms frame
+    FRAME_VALUES = SAMPLES_PER_FRAME * CHANNELS
+    #a single opus frame of silence
+    SILENCE_PACKET = b'\xf8\xff\xfe'
+    #what add_sound does once max_voices sounds are playing
+    OVERFLOW_POLICIES = ('oldest', 'newest', 'queue')
+    #frames for the headroom gain to recover from a full limit to unity
+    GAIN_RELEASE_FRAMES = 25
+    #frames read between publishing the source's gauges
+    STATS_FRAMES = 50
+
+    def __init__(self, sound_path=None, linger=False, on_idle=None,
+                 read_ahead=0, max_voices=None, overflow='queue', cache=None,
+                 guild_id=None):
+        """A source mixing any number of sounds into one opus stream
+
+        Normally the source ends once its last sound has played. With linger
+        set it instead sends one frame of silence, calls on_idle from the
+        audio thread, and keeps going for sounds added later, so the voice
+        client can pause rather than disconnect.
+
+        With read_ahead set to a number of frames, a producer thread mixes and
+        encodes that many frames ahead into a ring so read only hands out
+        ready packets, and add_sound loads sounds in the background.
+
+        max_voices caps how many sounds are mixed at once, which bounds the
+        work done per frame. When a sound is added at the cap, overflow picks
+        whether it replaces the oldest playing sound, is dropped itself, or
+        waits in a queue for a free voice. Mixed frames that would clip are
+        turned down by a limiter instead. Sounds' loudness envelopes let the
+        mixer skip their silent frames and bound the peak of a mix without
+        scanning it.
+
+        Given a SoundCache, sounds are taken from it and shared with every
+        other source playing them rather than loaded for this source alone.
+
+        Given a guild_id, the source publishes its counters as stats gauges
+        labelled with it once a second while playing and when cleaned up.
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(overflow))
+
+        self.__active_sounds = []
+        self.__cache = cache
+        #(sound, cached packets) waiting for a free voice
+        self.__waiting = collections.deque()
+        self.__max_voices = max_voices
+        self.__overflow = overflow
+        self.__dropped = 0
+        #current limiter gain, 1.0 while the mix fits in int16
+        self.__gain = 1.0
+        #a lone sound streams its packets cached at ingest, until a second
+        #sound is added and the source falls back to live mixing
+        self.__packets = None
+        self.__packet_index = 0
+        self.__linger = linger
+        self.__on_idle = on_idle
+        self.__idle = False
+        #add_sound runs on the event loop while read runs on the audio thread
+        self.__lock = threading.Lock()
+
+        #reused every frame so the 20ms loop does not allocate
+        self.__mix_buffer = numpy.zeros(self.FRAME_VALUES, dtype=numpy.int32)
+        self.__out_buffer = numpy.zeros(self.FRAME_VALUES, dtype=numpy.int16)
+        self.__gain_buffer = numpy.zeros(self.FRAME_VALUES, dtype=numpy.float32)
+        #0..1 across a frame, for ramping the gain without zipper noise
+        self.__ramp = numpy.repeat(
+            numpy.arange(self.SAMPLES_PER_FRAME, dtype=numpy.float32) /
+                self.SAMPLES_PER_FRAME,
+            self.CHANNELS)
+
+        #only created once something actually needs live encoding
+        self.__encoder = None
+
+        self.__read_ahead = read_ahead
+        self.__ring = collections.deque()
+        self.__ring_changed = threading.Condition()
+        self.__ring_finished = False
+        self.__producing = False
+        self.__stopped = False
+        self.__underruns = 0
+        #sounds still loading in the background
+        self.__loading = 0
+        #set by mark_join to time the first packet after a join
+        self.__join_started = None
+        self.__join_guild = None
+        self.__guild_id = guild_id
+        self.__frames_read = 0
+
+        if sound_path is not None:
+            self.__load_sound(sound_path)
+            if read_ahead:
+                self.__start_producer()
 
 
     def add_sound(self, sound_path):
-        self.__active_sounds.append(pydub.AudioSegment.from_file(sound_path))
+        if self.__read_ahead:
+            #mixed in at whichever frame is produced after it has loaded
+            with self.__lock:
+                self.__loading += 1
+            threading.Thread(target=self.__load_in_background,
+                             args=(sound_path,),
+                             daemon=True).start()
+            self.__start_producer()
+        else:
+            self.__load_sound(sound_path)
+
+
+    def __start_producer(self):
+        #a producer started with nothing to mix would end the stream at once
+        with self.__lock:
+            if self.__producing:
+                return
+            self.__producing = True
+        threading.Thread(target=self.__fill_ring,
+                         name='mixed-audio-read-ahead',
+                         daemon=True).start()
+
+
+    def __load_in_background(self, sound_path):
+        try:
+            self.__load_sound(sound_path)
+        except Exception as e:
+            traceback.print_exc()
+            print('Could not load {}: {}'.format(sound_path, e))
+        finally:
+            with self.__lock:
+                self.__loading -= 1
+
+
+    def __load_sound(self, sound_path):
+        #load outside the lock so the audio thread is never held up by I/O
+        if self.__cache is not None:
+            samples, packets, peaks = self.__cache.get(sound_path)
+        else:
+            samples = pcm_sidecar.load_samples(sound_path)
+            packets = opus_packets.load_packets(sound_path)
+            peaks, _ = envelopes.load_envelope(sound_path, samples)
+        if not len(samples):
+            #nothing to play, and the mixer expects a frame from every sound
+            print('Skipping empty sound {}'.format(sound_path))
+            return
+        sound = _ActiveSound(samples, peaks)
+        with self.__lock:
+            if self.__idle:
+                #drop silence queued up while idle so the sound starts at once
+                with self.__ring_changed:
+                    self.__ring.clear()
+                    self.__ring_changed.notify_all()
+            self.__idle = False
+            if (self.__max_voices is not None and
+                    len(self.__active_sounds) >= self.__max_voices):
+                if self.__overflow == 'queue':
+                    self.__waiting.append((sound, packets))
+                    return
+                self.__dropped += 1
+                if self.__overflow == 'newest':
+                    return
+                self.__steal_oldest_locked()
+            self.__start_locked(sound, packets)
+
+
+    def __start_locked(self, sound, packets):
+        if not self.__active_sounds:
+            self.__packets = packets
+            self.__packet_index = 0
+        elif self.__packets is not None:
+            #resume the first sound where its cached packets left off
+            self.__active_sounds[0].cursor = (self.__packet_index *
+                                              self.FRAME_VALUES)
+            self.__packets = None
+        self.__active_sounds.append(sound)
+
+
+    def __steal_oldest_locked(self):
+        self.__active_sounds.pop(0)
+        #a lone cached sound was the one stolen
+        self.__packets = None
+
+
+    def __start_waiting_locked(self):
+        while self.__waiting and (self.__max_voices is None or
+                                  len(self.__active_sounds) < self.__max_voices):
+            self.__start_locked(*self.__waiting.popleft())
+
+
+    def is_idle(self):
+        return (not self.__active_sounds and not self.__waiting and
+                not self.__loading)
+
+
+    def mark_join(self, started, guild_id):
+        """Record join to first packet latency from a time.perf_counter() reading"""
+        self.__join_guild = guild_id
+        self.__join_started = started
+
+
+    def read_ahead_stats(self):
+        """Underruns so far and how full the read-ahead ring currently is"""
+        return {
+            'underruns': self.__underruns,
+            'filled': len(self.__ring),
+            'capacity': self.__read_ahead,
+        }
+
+
+    def voice_stats(self):
+        """Sounds playing and waiting, sounds dropped at the cap, and limiter gain"""
+        return {
+            'active': len(self.__active_sounds),
+            'waiting': len(self.__waiting),
+            'dropped': self.__dropped,
+            'gain': self.__gain,
+        }
 
 
     def cleanup(self):
-        pass
+        with self.__ring_changed:
+            self.__stopped = True
+            self.__ring_changed.notify_all()
+        self.__publish_stats()
 
 
     def is_opus(self):
@@ -35,38 +266,196 @@ class MixedAudio(discord.AudioSource):
 
 
     def read(self):
-        if self.__active_sounds:
-            #base silence onto which to mix
-            mixed = pydub.AudioSegment.silent(duration=20, frame_rate=48000)
-
-            sounds_to_delete = []
-            for i in range(len(self.__active_sounds)):
-                #Pull out 20ms of each chunk and overlay it onto the silence
-                chunk = self.__active_sounds[i][:20]
-                self.__active_sounds[i] = self.__active_sounds[i][20:]
-                mixed = mixed.overlay(chunk)
-
-                #If we expend the sample mark it to remove from active
-                if len(self.__active_sounds[i]) == 0:
-                    sounds_to_delete.append(i)
-
-            #delete from the back of the list to the front
-            sounds_to_delete.reverse()
-            for i in sounds_to_delete:
-                del self.__active_sounds[i]
-
-            #get the raw data and pad/crop it to the exact length
-            raw_data = mixed.raw_data
-            expected_bytes = discord.opus.Encoder.SAMPLES_PER_FRAME * 2 * 16
-            if len(raw_data) < expected_bytes:
-                raw_data += b'\00' * (expected_bytes - len(raw_data))
-            elif len(raw_data) > expected_bytes:
-                raw_data = raw_data[:expected_bytes]
-
-            #opus encode the padded data
-            return self.__encoder.encode(raw_data,
-                                         discord.opus.Encoder.SAMPLES_PER_FRAME)
+        packet = self.__read_packet()
+
+        if self.__join_started is not None:
+            stats.observe('join_stage_ms', stats.since_ms(self.__join_started),
+                          stage='first_packet', guild=self.__join_guild)
+            self.__join_started = None
+
+        self.__frames_read += 1
+        if self.__frames_read % self.STATS_FRAMES == 0:
+            self.__publish_stats()
+        return packet
+
+
+    def __publish_stats(self):
+        if self.__guild_id is None:
+            return
+        if self.__read_ahead:
+            read_ahead = self.read_ahead_stats()
+            stats.set_gauge('read_ahead_underruns', read_ahead['underruns'],
+                            guild=self.__guild_id)
+            stats.set_gauge('read_ahead_filled', read_ahead['filled'],
+                            guild=self.__guild_id)
+
+        voices = self.voice_stats()
+        stats.set_gauge('voices_active', voices['active'], guild=self.__guild_id)
+        stats.set_gauge('voices_waiting', voices['waiting'], guild=self.__guild_id)
+        stats.set_gauge('voices_dropped', voices['dropped'], guild=self.__guild_id)
+        stats.set_gauge('limiter_gain', voices['gain'], guild=self.__guild_id)
+
+
+    def __read_packet(self):
+        if not self.__read_ahead:
+            return self.__produce()
+
+        with self.__ring_changed:
+            if self.__ring:
+                packet = self.__ring.popleft()
+                self.__ring_changed.notify_all()
+                return packet
+            if self.__ring_finished:
+                return b''
+            self.__underruns += 1
+
+        #keep the stream going rather than ending it early
+        return self.SILENCE_PACKET
+
+
+    def __fill_ring(self):
+        while True:
+            with self.__ring_changed:
+                while (len(self.__ring) >= self.__read_ahead and
+                       not self.__stopped):
+                    self.__ring_changed.wait()
+                if self.__stopped:
+                    return
+
+            packet = self.__produce()
+
+            with self.__ring_changed:
+                if not packet:
+                    self.__ring_finished = True
+                    return
+                self.__ring.append(packet)
+
+
+    def __produce(self):
+        with self.__lock:
+            if self.__packets is not None:
+                if self.__packet_index < len(self.__packets):
+                    return self.__produce_cached_locked()
+
+                #the cached sound has finished
+                self.__packets = None
+                self.__active_sounds = []
+                self.__start_waiting_locked()
+                if self.__packets is not None:
+                    return self.__produce_cached_locked()
+
+            pcm = None
+            silent = False
+            if self.__active_sounds:
+                mix_started = time.perf_counter()
+                pcm = self.__mix_locked()
+                silent = pcm is None
+                stats.observe('mix_frame_ms', stats.since_ms(mix_started))
+
+        if silent:
+            #nothing audible this frame, so there is nothing to encode
+            return self.SILENCE_PACKET
+
+        elif pcm is not None:
+            #opus encode the mixed frame
+            if self.__encoder is None:
+                self.__encoder = opus_packets.create_encoder()
+            with stats.timed('encode_ms'):
+                return self.__encoder.encode(pcm,
+                                             discord.opus.Encoder.SAMPLES_PER_FRAME)
+
+        elif self.__loading:
+            #wait for background loads rather than ending or idling
+            return self.SILENCE_PACKET
+
+        elif self.__linger:
+            if not self.__idle:
+                self.__idle = True
+                if self.__on_idle:
+                    self.__on_idle()
+            return self.SILENCE_PACKET
 
         else:
             #empty byte string is the signal for no more data
             return b''
+
+
+    def __produce_cached_locked(self):
+        packet = self.__packets[self.__packet_index]
+        self.__packet_index += 1
+        return packet
+
+
+    def __mix_locked(self):
+        """Mix the next 20ms of every active sound into one int16 PCM frame
+
+        Returns the frame as bytes, zero padded at the end of the last sound,
+        or None if every sound is silent in it.
+        """
+        mix = self.__mix_buffer
+        mix.fill(0)
+        mixed = False
+        #the sum of the envelope peaks bounds the mix, until a sound has none
+        peak_bound = 0
+
+        for sound in self.__active_sounds:
+            start = sound.cursor
+            sound.cursor = min(start + self.FRAME_VALUES, len(sound.samples))
+            if sound.peaks is not None:
+                frame_peak = int(sound.peaks[start // self.FRAME_VALUES])
+                if frame_peak < envelopes.SILENCE_PEAK:
+                    continue
+                if peak_bound is not None:
+                    peak_bound += frame_peak
+            else:
+                peak_bound = None
+
+            chunk = sound.samples[start:sound.cursor]
+            mix[:len(chunk)] += chunk
+            mixed = True
+
+        #drop expended sounds and give their voices to waiting ones
+        self.__active_sounds = [s for s in self.__active_sounds
+                                if s.remaining() > 0]
+        self.__start_waiting_locked()
+
+        if not mixed:
+            return None
+
+        self.__limit(mix, peak_bound)
+        #saturate back down to int16
+        numpy.clip(mix, -32768, 32767, out=mix)
+        numpy.copyto(self.__out_buffer, mix, casting='unsafe')
+        return self.__out_buffer.tobytes()
+
+
+    def __limit(self, mix, peak_bound=None):
+        """Scale the mix in place so overlapping sounds do not clip
+
+        The gain drops at once to whatever keeps this frame within int16 and
+        ramps back towards unity over GAIN_RELEASE_FRAMES. peak_bound, the sum
+        of the mixed sounds' envelope peaks, stands in for the frame's peak so
+        the mix is only scanned when a sound has no envelope.
+        """
+        if peak_bound is not None:
+            peak = peak_bound
+        else:
+            peak = max(int(mix.max()), -int(mix.min()))
+        target = min(1.0, 32767 / peak) if peak else 1.0
+        if target >= 1.0 and self.__gain >= 1.0:
+            return
+
+        previous = self.__gain
+        if target < previous:
+            self.__gain = target
+            gains = self.__gain_buffer
+            gains.fill(target)
+        else:
+            self.__gain = min(target, previous + 1.0 / self.GAIN_RELEASE_FRAMES)
+            gains = numpy.multiply(self.__ramp, self.__gain - previous,
+                                   out=self.__gain_buffer)
+            gains += previous
+
+        gains *= mix
+        numpy.rint(gains, out=gains)
+        numpy.copyto(mix, gains, casting='unsafe')
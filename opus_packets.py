@@ -0,0 +1,134 @@
+"""Pre-encoded Opus packet sequences stored next to each processed sound
+
+Most joins play one sound with nothing overlapping it, so the encoded output
+is identical every time. The packets are encoded once at ingest with the same
+encoder settings MixedAudio uses and streamed straight from this cache when a
+sound plays on its own.
+"""
+
+import os
+import pathlib
+import struct
+import tempfile
+import zlib
+
+import discord
+
+ENCODER_SETTINGS = {
+    'application': 'audio',
+    'bitrate': 128,
+    'fec': True,
+    'expected_packet_loss': 0.15,
+    'bandwidth': 'full',
+    'signal_type': 'auto',
+}
+
+MAGIC = b'LLOPUS\x00\x01'
+#packets encoded under different settings must not be streamed
+SETTINGS_TAG = zlib.crc32(repr(sorted(ENCODER_SETTINGS.items())).encode())
+
+#magic, settings tag, packet count
+_HEADER = struct.Struct('<8sII')
+_LENGTH = struct.Struct('<H')
+
+
+def create_encoder():
+    return discord.opus.Encoder(**ENCODER_SETTINGS)
+
+
+def packets_path(sound_path):
+    return pathlib.Path(sound_path).with_suffix('.opus')
+
+
+class PacketWriter:
+    """Encodes consecutive chunks of raw data into the packet cache of sound_path
+
+    Chunks do not have to line up with frames; the last partial frame is
+    zero padded by close(), which writes the cache and renames it into place.
+    """
+    def __init__(self, sound_path):
+        self.__path = packets_path(sound_path)
+        self.__encoder = create_encoder()
+        self.__pending = b''
+        self.__packets = []
+
+
+    def write(self, raw_data):
+        """Encode 48kHz stereo s16le raw_data into 20ms Opus packets"""
+        frame_size = discord.opus.Encoder.FRAME_SIZE
+        data = self.__pending + raw_data if self.__pending else raw_data
+        whole = len(data) - len(data) % frame_size
+
+        for start in range(0, whole, frame_size):
+            self.__packets.append(self.__encoder.encode(
+                data[start:start + frame_size],
+                discord.opus.Encoder.SAMPLES_PER_FRAME))
+        self.__pending = data[whole:]
+
+
+    def close(self):
+        if self.__pending:
+            frame_size = discord.opus.Encoder.FRAME_SIZE
+            self.write(b'\x00' * (frame_size - len(self.__pending)))
+
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        #unique so writers of the same cache never share a temporary file
+        fd, tmp_path = tempfile.mkstemp(prefix=self.__path.name + '.',
+                                        suffix='.tmp',
+                                        dir=self.__path.parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, SETTINGS_TAG, len(self.__packets)))
+                for packet in self.__packets:
+                    f.write(_LENGTH.pack(len(packet)))
+                    f.write(packet)
+            os.replace(tmp_path, self.__path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return self.__path
+
+
+def write_packets(sound_path, raw_data):
+    writer = PacketWriter(sound_path)
+    writer.write(raw_data)
+    return writer.close()
+
+
+def delete_packets(sound_path):
+    packets_path(sound_path).unlink(missing_ok=True)
+
+
+def load_packets(sound_path):
+    """Return the cached packets of sound_path, or None if they are unusable
+
+    Missing, stale or differently encoded caches return None so the caller
+    falls back to encoding live.
+    """
+    sound_path = pathlib.Path(sound_path)
+    path = packets_path(sound_path)
+    try:
+        if path.stat().st_mtime < sound_path.stat().st_mtime:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    if len(data) < _HEADER.size:
+        return None
+    magic, tag, count = _HEADER.unpack_from(data)
+    if magic != MAGIC or tag != SETTINGS_TAG:
+        return None
+
+    packets = []
+    offset = _HEADER.size
+    try:
+        for _ in range(count):
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            packets.append(data[offset:offset + length])
+            offset += length
+    except struct.error:
+        return None
+    return packets
@@ -0,0 +1,152 @@
+"""Raw PCM sidecar files stored next to each processed sound
+
+A sidecar holds the sound already decoded to 48kHz, stereo, signed 16 bit
+little endian samples behind a small fixed size header. Playback memory-maps
+it and reads frames straight out of the mapping, so no ffmpeg decode happens
+between a join and its first packet, and every guild playing the same clip
+shares the same page cache pages.
+"""
+
+import hashlib
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+
+import numpy
+
+import stats
+
+MAGIC = b'LLPCM\x00\x00\x01'
+SAMPLE_RATE = 48000
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+
+#magic, sample rate, channels, sample width, number of interleaved values
+_HEADER = struct.Struct('<8sIHHQ')
+#padded so the sample data stays aligned for numpy
+HEADER_SIZE = 32
+
+
+def sidecar_path(sound_path):
+    return pathlib.Path(sound_path).with_suffix('.pcm')
+
+
+class SidecarWriter:
+    """Builds the sidecar of sound_path from consecutive chunks of raw data
+
+    The file is written under a unique temporary name and renamed into place
+    by close() so a concurrent reader never maps a partially written sidecar,
+    and writers of the same sidecar never share a file.
+    """
+    def __init__(self, sound_path):
+        self.__path = sidecar_path(sound_path)
+        self.__values = 0
+
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=self.__path.name + '.',
+                                        suffix='.tmp',
+                                        dir=self.__path.parent)
+        self.__tmp_path = pathlib.Path(tmp_path)
+        self.__file = os.fdopen(fd, 'wb')
+        #the real header is filled in once the length is known
+        self.__file.write(b'\x00' * HEADER_SIZE)
+
+
+    def write(self, raw_data):
+        """Append 48kHz stereo s16le raw_data"""
+        self.__file.write(raw_data)
+        self.__values += len(raw_data) // SAMPLE_WIDTH
+
+
+    def close(self):
+        header = _HEADER.pack(MAGIC, SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH,
+                              self.__values)
+        self.__file.seek(0)
+        self.__file.write(header)
+        self.__file.close()
+        os.replace(self.__tmp_path, self.__path)
+        return self.__path
+
+
+    def discard(self):
+        self.__file.close()
+        self.__tmp_path.unlink(missing_ok=True)
+
+
+def write_sidecar(sound_path, raw_data):
+    """Write 48kHz stereo s16le raw_data as the sidecar of sound_path"""
+    writer = SidecarWriter(sound_path)
+    writer.write(raw_data)
+    return writer.close()
+
+
+def delete_sidecar(sound_path):
+    sidecar_path(sound_path).unlink(missing_ok=True)
+
+
+def open_sidecar(path):
+    """Memory-map a sidecar and return its samples as a read-only int16 array"""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError('Truncated sound sidecar {}'.format(path))
+
+        magic, rate, channels, width, count = _HEADER.unpack_from(header)
+        if (magic != MAGIC or rate != SAMPLE_RATE or
+                channels != CHANNELS or width != SAMPLE_WIDTH):
+            raise ValueError('Unsupported sound sidecar {}'.format(path))
+
+        if count == 0:
+            return numpy.zeros(0, dtype=numpy.int16)
+
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    #the array keeps the mapping alive for as long as it is referenced
+    return numpy.frombuffer(mapping, dtype=numpy.int16,
+                            count=count, offset=HEADER_SIZE)
+
+
+def measure(samples):
+    """Duration, peak and RMS level (as fractions of full scale) and a hash
+
+    The hash covers the normalised PCM, so identical sounds hash the same no
+    matter how they were uploaded.
+    """
+    if len(samples):
+        peak = float(numpy.abs(samples.astype(numpy.int32)).max()) / 32768
+        rms = float(numpy.sqrt(numpy.mean(samples.astype(numpy.float64) ** 2))) / 32768
+    else:
+        peak = rms = 0.0
+
+    return {
+        'duration_ms': len(samples) / CHANNELS / SAMPLE_RATE * 1000,
+        'peak': peak,
+        'rms': rms,
+        'content_hash': hashlib.sha256(samples.tobytes()).hexdigest(),
+    }
+
+
+def load_samples(sound_path):
+    """Return the samples of sound_path, creating its sidecar if missing
+
+    Sounds added before sidecars existed, or replaced since their sidecar was
+    written, are decoded once here and migrated.
+    """
+    sound_path = pathlib.Path(sound_path)
+    path = sidecar_path(sound_path)
+
+    if (not path.is_file() or
+            path.stat().st_mtime < sound_path.stat().st_mtime):
+        #pydub probes for ffmpeg on import, only pay for that when migrating
+        import pydub
+
+        with stats.timed('ffmpeg_decode_ms', source='migration'):
+            sound = pydub.AudioSegment.from_file(sound_path)
+        sound = sound.set_frame_rate(SAMPLE_RATE)
+        sound = sound.set_channels(CHANNELS)
+        sound = sound.set_sample_width(SAMPLE_WIDTH)
+        write_sidecar(sound_path, sound.raw_data)
+
+    return open_sidecar(path)
@@ -0,0 +1,115 @@
+"""Process wide LRU cache of loaded sounds, shared by every guild's mixer
+
+A cached sound is its sidecar samples, its Opus packets and the peaks of its
+loudness envelope, keyed by path and modification time so a replaced file is
+never served stale. Mixers only read from what they are handed: the samples
+are a read-only array over the sidecar mapping and the packets a tuple, so
+any number of sources can play the same entry at once without copying it.
+Entries are evicted least recently used first once the total size passes
+the budget.
+
+The budget is read from the environment:
+    LLAMABOT_SOUND_CACHE_MB   bytes of sounds to keep (default: 256)
+"""
+
+import collections
+import os
+import pathlib
+import threading
+import traceback
+
+import envelopes
+import opus_packets
+import pcm_sidecar
+import stats
+
+
+class SoundCache:
+    def __init__(self, max_bytes=None):
+        self.__max_bytes = max_bytes or int(
+            float(os.getenv('LLAMABOT_SOUND_CACHE_MB', 256)) * 1024 * 1024)
+        self.__lock = threading.Lock()
+        #(path, mtime) -> (samples, packets, peaks, size), least recently used first
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__hits = 0
+        self.__misses = 0
+
+
+    def get(self, sound_path):
+        """Return (samples, packets or None, peaks) for sound_path
+
+        The sound is loaded on a miss.
+        """
+        sound_path = pathlib.Path(sound_path)
+        key = (str(sound_path), sound_path.stat().st_mtime_ns)
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+        if entry is not None:
+            self.__publish()
+            return entry[:3]
+
+        #load outside the lock, a racing miss for the same sound just loads twice
+        samples = pcm_sidecar.load_samples(sound_path)
+        packets = opus_packets.load_packets(sound_path)
+        if packets is not None:
+            packets = tuple(packets)
+        peaks, _ = envelopes.load_envelope(sound_path, samples)
+        size = (samples.nbytes + peaks.nbytes +
+                sum(len(packet) for packet in packets or ()))
+
+        with self.__lock:
+            self.__misses += 1
+            if key not in self.__entries:
+                self.__entries[key] = (samples, packets, peaks, size)
+                self.__bytes += size
+                self.__evict()
+        self.__publish()
+        return samples, packets, peaks
+
+
+    def prewarm(self, sound_paths, until_full=False):
+        """Load sound_paths ahead of time, ignoring any that fail to load
+
+        With until_full set, stop once the budget is used up rather than
+        evicting sounds loaded earlier in the same call.
+        """
+        for sound_path in sound_paths:
+            if until_full and self.__bytes >= self.__max_bytes:
+                break
+            try:
+                self.get(sound_path)
+            except Exception as e:
+                traceback.print_exc()
+                print('Could not prewarm {}: {}'.format(sound_path, e))
+
+
+    def cache_stats(self):
+        """Hits, misses, hit rate, entries and bytes held against the budget"""
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                'hits': self.__hits,
+                'misses': self.__misses,
+                'hit_rate': self.__hits / lookups if lookups else 0.0,
+                'entries': len(self.__entries),
+                'resident_bytes': self.__bytes,
+                'max_bytes': self.__max_bytes,
+            }
+
+
+    def __evict(self):
+        #called with the lock held, always keeping the entry just added
+        while self.__bytes > self.__max_bytes and len(self.__entries) > 1:
+            _, (_, _, _, size) = self.__entries.popitem(last=False)
+            self.__bytes -= size
+
+
+    def __publish(self):
+        cache_stats = self.cache_stats()
+        stats.set_gauge('sound_cache_hit_rate', cache_stats['hit_rate'])
+        stats.set_gauge('sound_cache_resident_bytes', cache_stats['resident_bytes'])
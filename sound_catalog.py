@@ -0,0 +1,209 @@
+"""SQLite catalog of every registered sound
+
+One row per (owner, guild, name) holds the weight, loudness statistics,
+content hash and the paths of the stored files, so listing, lookup and the
+startup load of the selection index are single indexed queries instead of
+directory walks and ID3 tag probes. Rows of identical sounds share one set
+of files, see sound_store.
+
+Existing sound trees are imported once with import_tree, which runs
+automatically when the catalog is empty or by hand with:
+
+    python sound_catalog.py [sounds_root]
+"""
+
+import collections
+import pathlib
+import sqlite3
+import sys
+import time
+
+import pcm_sidecar
+import sound_store
+
+SoundEntry = collections.namedtuple('SoundEntry', [
+    'owner_id',
+    'guild_id',
+    'name',
+    'weight',
+    'duration_ms',
+    'peak',
+    'rms',
+    'content_hash',
+    'mp3_path',
+    'pcm_path',
+    'opus_path',
+    'added_at',
+])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sounds (
+    owner_id INTEGER NOT NULL,
+    guild_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    weight INTEGER NOT NULL,
+    duration_ms REAL,
+    peak REAL,
+    rms REAL,
+    content_hash TEXT,
+    mp3_path TEXT NOT NULL,
+    pcm_path TEXT,
+    opus_path TEXT,
+    added_at REAL NOT NULL,
+    PRIMARY KEY (owner_id, guild_id, name)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS sounds_by_hash ON sounds (content_hash);
+CREATE INDEX IF NOT EXISTS sounds_by_path ON sounds (mp3_path);
+"""
+
+_COLUMNS = ', '.join(SoundEntry._fields)
+_PLACEHOLDERS = ', '.join('?' * len(SoundEntry._fields))
+
+
+class SoundCatalog:
+    FILE_NAME = 'catalog.sqlite3'
+
+    def __init__(self, sounds_root='./sounds'):
+        root = pathlib.Path(sounds_root)
+        root.mkdir(parents=True, exist_ok=True)
+
+        #only used from the event loop, but created before it starts
+        self.__db = sqlite3.connect(root / self.FILE_NAME,
+                                    check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.executescript(_SCHEMA)
+
+
+    def close(self):
+        self.__db.close()
+
+
+    def is_empty(self):
+        return self.__db.execute('SELECT 1 FROM sounds LIMIT 1').fetchone() is None
+
+
+    def add_sound(self, entry):
+        """Insert or replace one sound"""
+        self.add_sounds([entry])
+
+
+    def add_sounds(self, entries):
+        """Insert or replace several sounds in a single transaction"""
+        with self.__db:
+            self.__db.executemany(
+                'INSERT OR REPLACE INTO sounds ({}) VALUES ({})'.format(
+                    _COLUMNS, _PLACEHOLDERS),
+                [tuple(entry) for entry in entries])
+
+
+    def remove_sound(self, owner_id, guild_id, name):
+        """Delete one sound, returning its SoundEntry or None if there was none"""
+        with self.__db:
+            entry = self.__get(owner_id, guild_id, name)
+            if entry:
+                self.__db.execute(
+                    'DELETE FROM sounds WHERE owner_id=? AND guild_id=? AND name=?',
+                    (owner_id, guild_id, name))
+        return entry
+
+
+    def references(self, mp3_path):
+        """Number of sounds sharing the stored file at mp3_path"""
+        (count,) = self.__db.execute(
+            'SELECT COUNT(*) FROM sounds WHERE mp3_path=?',
+            (str(mp3_path),)).fetchone()
+        return count
+
+
+    def get_sound(self, owner_id, guild_id, name):
+        return self.__get(owner_id, guild_id, name)
+
+
+    def list_sounds(self, owner_id, guild_id=None):
+        """Sounds of one owner ordered by guild then name, optionally for one guild"""
+        if guild_id is None:
+            rows = self.__db.execute(
+                'SELECT {} FROM sounds WHERE owner_id=? '
+                'ORDER BY guild_id, name'.format(_COLUMNS),
+                (owner_id,))
+        else:
+            rows = self.__db.execute(
+                'SELECT {} FROM sounds WHERE owner_id=? AND guild_id=? '
+                'ORDER BY name'.format(_COLUMNS),
+                (owner_id, guild_id))
+        return [SoundEntry(*row) for row in rows]
+
+
+    def selection_entries(self):
+        """Yield (owner id, guild id, name, weight, mp3 path) for every sound"""
+        yield from self.__db.execute(
+            'SELECT owner_id, guild_id, name, weight, mp3_path FROM sounds')
+
+
+    def __get(self, owner_id, guild_id, name):
+        row = self.__db.execute(
+            'SELECT {} FROM sounds WHERE owner_id=? AND guild_id=? AND name=?'.format(
+                _COLUMNS),
+            (owner_id, guild_id, name)).fetchone()
+        return SoundEntry(*row) if row else None
+
+
+def make_entry(owner_id, guild_id, name, weight, mp3_path, measurements):
+    """Build a SoundEntry for a stored mp3 from pcm_sidecar.measure output"""
+    return SoundEntry(owner_id=int(owner_id),
+                      guild_id=int(guild_id),
+                      name=name,
+                      weight=int(weight),
+                      duration_ms=measurements['duration_ms'],
+                      peak=measurements['peak'],
+                      rms=measurements['rms'],
+                      content_hash=measurements['content_hash'],
+                      mp3_path=str(mp3_path),
+                      pcm_path=str(pcm_sidecar.sidecar_path(mp3_path)),
+                      opus_path=str(pathlib.Path(mp3_path).with_suffix('.opus')),
+                      added_at=time.time())
+
+
+def import_tree(catalog, sounds_root='./sounds'):
+    """One-off import of ./sounds/<owner>/<guild>/<name>.mp3 files
+
+    Returns the number of sounds imported.
+    """
+    entries = scan_tree(sounds_root)
+    catalog.add_sounds(entries)
+    return len(entries)
+
+
+def scan_tree(sounds_root='./sounds'):
+    """Blocking, build SoundEntry rows for ./sounds/<owner>/<guild>/<name>.mp3 files
+
+    Weights come from the ID3 tags the bot used to write. Sounds without a
+    sidecar are decoded to get one, so this can take a while and does not
+    touch the catalog.
+    """
+    import pydub
+
+    entries = []
+    for sound in pathlib.Path(sounds_root).glob('*/*/*.mp3'):
+        #shared blobs are only ever referenced by entries, never imported
+        if sound.parent.parent.name == sound_store.BLOB_ROOT.name:
+            continue
+        try:
+            weight = int(pydub.utils.mediainfo(sound)['TAG']['weight'])
+            measurements = pcm_sidecar.measure(pcm_sidecar.load_samples(sound))
+            entries.append(make_entry(sound.parent.parent.name,
+                                      sound.parent.name,
+                                      sound.stem,
+                                      weight,
+                                      sound,
+                                      measurements))
+        except Exception as e:
+            print('Could not import {}: {}'.format(sound, e))
+
+    return entries
+
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else './sounds'
+    print('Imported {} sounds'.format(import_tree(SoundCatalog(root), root)))
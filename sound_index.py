@@ -0,0 +1,104 @@
+"""In-memory index of every member's sounds and their weights
+
+The index is loaded from the sound catalog once at startup and then kept up
+to date alongside it, so picking a join sound never touches the disk. The
+load may happen in the background after the bot connects; joins wait for it
+with wait_loaded.
+Selection bisects a cumulative weight table instead of building a list
+holding each sound weight times.
+"""
+
+import asyncio
+import bisect
+import itertools
+import pathlib
+import random
+
+
+class SoundIndex:
+    def __init__(self, loaded=True):
+        """An empty index, or one that joins wait on until add_entries if not loaded"""
+        #(member id, guild id) -> {sound name: (weight, path)}
+        self.__sounds = {}
+        #(member id, guild id) -> (sound paths, cumulative weights)
+        self.__tables = {}
+        self.__loaded = asyncio.Event()
+        if loaded:
+            self.__loaded.set()
+
+
+    def add_entries(self, entries):
+        """Fill the index from SoundCatalog.selection_entries rows and mark it loaded
+
+        Sounds already set since startup are newer than the rows and are kept.
+        """
+        for member_id, guild_id, name, weight, path in entries:
+            key = (str(member_id), str(guild_id))
+            self.__sounds.setdefault(key, {}).setdefault(name, (weight,
+                                                                pathlib.Path(path)))
+        self.__tables.clear()
+        self.__loaded.set()
+
+
+    @property
+    def loaded(self):
+        return self.__loaded.is_set()
+
+
+    async def wait_loaded(self):
+        await self.__loaded.wait()
+
+
+    def set_sound(self, member_id, guild_id, sound_name, sound_weight, sound_path):
+        self.update_sounds(member_id, guild_id,
+                           {sound_name: (sound_weight, sound_path)})
+
+
+    def update_sounds(self, member_id, guild_id, sounds):
+        """Set several {sound name: (weight, path)} entries at once"""
+        key = (str(member_id), str(guild_id))
+        entries = self.__sounds.setdefault(key, {})
+        for sound_name, (sound_weight, sound_path) in sounds.items():
+            entries[sound_name] = (int(sound_weight), pathlib.Path(sound_path))
+        self.__tables.pop(key, None)
+
+
+    def remove_sound(self, member_id, guild_id, sound_name):
+        key = (str(member_id), str(guild_id))
+        sounds = self.__sounds.get(key, {})
+        if sounds.pop(sound_name, None) is None:
+            return False
+
+        if not sounds:
+            del self.__sounds[key]
+        self.__tables.pop(key, None)
+        return True
+
+
+    def sounds(self, member_id, guild_id):
+        """Return a {sound name: (weight, path)} copy for one member in one guild"""
+        return dict(self.__sounds.get((str(member_id), str(guild_id)), {}))
+
+
+    def choose(self, member_id, guild_id):
+        """Pick a weighted random sound path, or None if there is nothing to play"""
+        key = (str(member_id), str(guild_id))
+        if key not in self.__tables:
+            if key not in self.__sounds:
+                return None
+            self.__tables[key] = self.__build_table(self.__sounds[key])
+
+        paths, cumulative = self.__tables[key]
+        if not paths:
+            return None
+
+        pick = random.randrange(cumulative[-1])
+        return paths[bisect.bisect_right(cumulative, pick)]
+
+
+    def __build_table(self, sounds):
+        #non-positive weights can never be picked, same as the old repeat list
+        chosen = [(path, weight) for weight, path in sounds.values() if weight > 0]
+        paths = [path for path, _ in chosen]
+        cumulative = list(itertools.accumulate(weight for _, weight in chosen))
+        return paths, cumulative
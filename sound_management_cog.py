@@ -1,22 +1,52 @@
 
 import asyncio
+import contextlib
+import functools
+import math
 import typing
 import os
 import pathlib
+import shlex
+import shutil
+import time
 import traceback
+import zipfile
 
 import discord
 from discord.ext import commands
-import pydub
-import yt_dlp
+
+import ingest_queue
+import sound_catalog
+import sound_processing
+import sound_store
+import stats
+import worker_pool
+import youtube_cache
 
 
 class SoundManagementCog(commands.Cog):
-    MAX_SOUND_MS = 6000.0
-    def __init__(self, bot):
+    MAX_SOUND_MS = sound_processing.MAX_SOUND_MS
+    #limits on a single import_sounds command
+    MAX_IMPORT_SOUNDS = 50
+    MAX_IMPORT_FILE_BYTES = 50 * 1024 * 1024
+    MANIFEST_NAME = 'manifest.txt'
+    #zip entries imported as sounds, anything else is reported and skipped
+    AUDIO_EXTENSIONS = ('.aac', '.flac', '.m4a', '.mp3', '.ogg', '.opus', '.wav',
+                        '.webm')
+    def __init__(self, bot, catalog, sound_index, workers, clip_cache=None):
         self.__bot = bot
-        self.__attachment_lock = asyncio.Lock()
-        self.__youtube_lock = asyncio.Lock()
+        self.__catalog = catalog
+        self.__sound_index = sound_index
+        self.__workers = workers
+        self.__ingest = ingest_queue.IngestQueue()
+        self.__clip_cache = clip_cache or youtube_cache.YoutubeCache()
+        #sounds of one import processed at once
+        self.__import_jobs = int(os.getenv('LLAMABOT_IMPORT_JOBS',
+                                           os.cpu_count() or 1))
+        #ingests between processing and their catalog commit, and the blobs
+        #whose deletion waits for them
+        self.__ingests = 0
+        self.__deferred_blobs = set()
 
     ######################
     # add_sound_attached #
@@ -24,7 +54,7 @@ class SoundManagementCog(commands.Cog):
     @commands.command(
         help="""This command adds an attached audio file to your sound list with the specified name and weight.
 
-        If the audio file is longer than 6 seconds, it is sped up chipmunk style to meet the time limit. All files are given a 250ms fade in/fade out to prevent unintentional speaker clipping.
+        Silence at the start and end is trimmed. If what is left is longer than 6 seconds, it is sped up chipmunk style to meet the time limit. All files are given a 250ms fade in/fade out to prevent unintentional speaker clipping.
 
         If run in a server this command will add the sound to your list for that server, if run in DMs you must specify the server. See !list_servers for a list of valid servers.""",
         brief="""[name] [weight] [guild_identifer]""",
@@ -40,15 +70,16 @@ class SoundManagementCog(commands.Cog):
                 description='Server name or server ID. With spaces you must use quotes'),
            ):
 
-        async with ctx.typing(), self.__attachment_lock:
-            if not attachment or 'audio' not in attachment.content_type:
-                await ctx.reply('Must attach audio file')
-                return
+        if not attachment or 'audio' not in attachment.content_type:
+            await ctx.reply('Must attach audio file')
+            return
 
+        on_queued = functools.partial(self.__report_queue_position, ctx)
+        async with ctx.typing(), self.__ingest.workspace(ctx.author.id,
+                                                          on_queued) as work_dir:
             extension = ''.join(pathlib.Path(attachment.filename).suffixes)
-            work_path = pathlib.Path('./work/attachment{}'.format(extension))
+            work_path = work_dir / 'attachment{}'.format(extension)
 
-            work_path.parent.mkdir(parents=True, exist_ok=True)
             await attachment.save(work_path)
 
             await self.__add_sound_common(ctx,
@@ -57,7 +88,6 @@ class SoundManagementCog(commands.Cog):
                                           guild_identifier,
                                           work_path,
                                           0)
-            work_path.unlink()
 
     #####################
     # add_sound_youtube #
@@ -65,7 +95,7 @@ class SoundManagementCog(commands.Cog):
     @commands.command(
         help="""This command downloads audio from a Youtube video and crops it to the given start and end time before adding it to your sound list with the specified name and weight.
 
-        If the audio file is longer than 6 seconds, it is sped up chipmunk style to meet the time limit. All files are given a 250ms fade in/fade out to prevent unintentional speaker clipping.
+        Silence at the start and end is trimmed. If what is left is longer than 6 seconds, it is sped up chipmunk style to meet the time limit. All files are given a 250ms fade in/fade out to prevent unintentional speaker clipping.
 
         If run in a server this command will add the sound to your list for that server, if run in DMs you must specify the server. See !list_servers for a list of valid servers.""",
         brief="""[url] [start_time] [end_time] [name] [weight] [guild_identifier]""",
@@ -94,22 +124,19 @@ class SoundManagementCog(commands.Cog):
             await ctx.reply('Start/end time invalid: ' + str(e))
             return
 
-        async with ctx.typing(), self.__youtube_lock:
+        on_queued = functools.partial(self.__report_queue_position, ctx)
+        async with ctx.typing(), self.__ingest.workspace(ctx.author.id,
+                                                          on_queued) as work_dir:
             try:
-                yt_opts = {
-                    'verbose': True,
-                    'download_ranges':
-                        yt_dlp.utils.download_range_func(None, [(start_time,
-                                                                 end_time)]),
-                    'force_keyframes_at_cuts': True,
-                    'format':'ba', #best audio only format
-                    'outtmpl':'work/youtube.%(ext)s',
-                    'noplaylist':True,
-                }
-
-                with yt_dlp.YoutubeDL(yt_opts) as ydl:
-                    info_dict = ydl.extract_info(url, download=True)
-                    work_path = pathlib.Path(ydl.prepare_filename(info_dict))
+                work_path = work_dir / 'youtube.wav'
+                started = time.perf_counter()
+                cached = await self.__workers.run_io(self.__clip_cache.fetch_clip,
+                                                     url,
+                                                     start_time,
+                                                     end_time,
+                                                     work_path)
+                stats.observe('youtube_fetch_ms', stats.since_ms(started),
+                              cache='hit' if cached else 'miss')
 
                 await self.__add_sound_common(ctx,
                                               sound_name,
@@ -117,13 +144,74 @@ class SoundManagementCog(commands.Cog):
                                               guild_identifier,
                                               work_path,
                                               10)
-                work_path.unlink()
 
             except Exception as e:
                 print(e)
                 traceback.print_exc()
                 await ctx.reply(str(e))
 
+    #################
+    # import_sounds #
+    #################
+    @commands.command(
+        help="""This command adds many sounds at once from an attached zip archive or several attached audio files.
+
+        An optional manifest.txt, attached or inside the zip, sets each sound's name and weight with one "file name weight" line per sound. Files without a line are named after the file and given weight 1. Up to 50 sounds can be imported at once, and you get a single summary reply when they are done.
+
+        If run in a server this command will add the sounds to your list for that server, if run in DMs you must specify the server. See !list_servers for a list of valid servers.""",
+        brief="""[guild_identifier]""",
+        aliases=['is'])
+    async def import_sounds(self, ctx,
+            guild_identifier=commands.parameter(default=None,
+                description='Server name or server ID. With spaces you must use quotes'),
+           ):
+        try:
+            guild = self.__parse_guild(ctx, guild_identifier)
+        except Exception as e:
+            await ctx.reply(str(e))
+            return
+
+        if not ctx.message.attachments:
+            await ctx.reply('Must attach a zip archive or audio files')
+            return
+
+        on_queued = functools.partial(self.__report_queue_position, ctx)
+        async with ctx.typing(), self.__ingest.workspace(ctx.author.id,
+                                                          on_queued) as work_dir:
+            try:
+                files, skipped, manifest = await self.__collect_import(
+                                                    ctx.message.attachments, work_dir)
+                jobs, failures = self.__plan_import(files, manifest)
+                failures = [(name, 'Not an audio file') for name in skipped] + failures
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+                await ctx.reply(str(e))
+                return
+
+            total = len(jobs) + len(failures)
+            with self.__holding_blobs():
+                limit = asyncio.Semaphore(self.__import_jobs)
+                results = await asyncio.gather(*(self.__import_one(i, job,
+                                                                   work_dir, limit)
+                                                 for i, job in enumerate(jobs)))
+
+                imported = {}
+                for (sound_name, sound_weight, _), result in zip(jobs, results):
+                    if isinstance(result, Exception):
+                        failures.append((sound_name, str(result)))
+                    else:
+                        imported[sound_name] = (sound_weight, result)
+
+                if imported:
+                    self.__commit_import(ctx.author.id, guild.id, imported)
+
+        lines = ['Imported {} of {} sounds to server {}'.format(
+                     len(imported), total, guild.name)]
+        lines += ['{}: {}'.format(name, error) for name, error in failures]
+        #stay under discord's message length limit
+        await ctx.reply('\n'.join(lines)[:1900])
+
     ################
     # delete_sound #
     ################
@@ -146,17 +234,14 @@ class SoundManagementCog(commands.Cog):
             print(e)
             traceback.print_exc()
             await ctx.reply(str(e))
+            return
 
-        sound_path = (pathlib.Path('./sounds') /
-                      str(ctx.author.id) /
-                      str(guild.id) /
-                      sound_name
-                     ).with_suffix('.mp3')
-
-        if not sound_path.is_file():
+        entry = self.__catalog.remove_sound(ctx.author.id, guild.id, sound_name)
+        if not entry:
             await ctx.reply('Sound file does not exist')
         else:
-            sound_path.unlink()
+            self.__sound_index.remove_sound(ctx.author.id, guild.id, sound_name)
+            self.__release_blob(entry.mp3_path)
             await ctx.reply('Successfully deleted sound {} from server {}'.format(
                                 sound_name, guild.name))
 
@@ -179,9 +264,10 @@ class SoundManagementCog(commands.Cog):
     # list_sounds #
     ###############
     @commands.command(
-        help="""This command lists your registered sounds.
+        help="""This command lists your registered sounds with their length and loudness.
 
-        If you give it a guild identifer it will show you the sounds for that guild, otherwise it will show you all of your sound lists.""",
+        If you give it a guild identifer it will show you the sounds for that guild, otherwise it will show you all of your sound lists.
+        Loudness is the average (RMS) level in dB below full scale, so -10 dBFS is louder than -20 dBFS.""",
         brief="""[guild_identifier]""",
         aliases=['lsnd'])
     async def list_sounds(self, ctx,
@@ -190,7 +276,7 @@ class SoundManagementCog(commands.Cog):
                          ):
         #If no guild info and in DM list all sounds
         if guild_identifier == None and ctx.guild == None:
-            sounds_path = pathlib.Path('./sounds') / str(ctx.author.id)
+            entries = self.__catalog.list_sounds(ctx.author.id)
             lines = ['Here are your sounds for all servers']
         else:
             try:
@@ -200,14 +286,16 @@ class SoundManagementCog(commands.Cog):
                 traceback.print_exc()
                 await ctx.reply(str(e))
                 return
-            sounds_path = pathlib.Path('./sounds') / str(ctx.author.id) / str(guild.id)
+            entries = self.__catalog.list_sounds(ctx.author.id, guild.id)
             lines = ['Here are your sounds for server "{}"'.format(guild.name)]
 
-        lines += ['Server - Sound name']
-        lines += [p.parent.name + ' - ' + p.stem
-                    for p in filter(lambda p: p.is_file(),  #only take files
-                                    sounds_path.rglob('*')) #from all nodes
-                 ]
+        #length and loudness were measured at ingest, so nothing is decoded here
+        lines += ['Server - Sound name - Length - Loudness']
+        lines += ['{} - {} - {:.1f}s - {}'.format(entry.guild_id,
+                                                 entry.name,
+                                                 (entry.duration_ms or 0) / 1000,
+                                                 self.__format_loudness(entry.rms))
+                  for entry in entries]
 
         await ctx.reply('\n'.join(lines))
 
@@ -231,14 +319,15 @@ class SoundManagementCog(commands.Cog):
             print(e)
             traceback.print_exc()
             await ctx.reply(str(e))
+            return
+
+        entry = self.__catalog.get_sound(ctx.author.id, guild.id, sound_name)
+        if not entry:
+            await ctx.reply('Sound file does not exist')
+            return
 
-        sound_path = (pathlib.Path('./sounds') /
-                      str(ctx.author.id) /
-                      str(guild.id) /
-                      sound_name
-                     ).with_suffix('.mp3')
         try:
-            file = discord.File(sound_path)
+            file = discord.File(entry.mp3_path, filename=sound_name + '.mp3')
         except Exception as e:
             print(e)
         await ctx.reply(file=file, content='Here is {}'.format(sound_name))
@@ -257,21 +346,44 @@ class SoundManagementCog(commands.Cog):
             (sound_name, sound_weight) = self.__parse_sound_info(sound_name,
                                                                  sound_weight)
         except Exception as e:
-            return str(e)
+            await ctx.reply(str(e))
+            return
 
-        file_path = (pathlib.Path('./sounds') /
-                     str(ctx.author.id) /
-                     str(guild.id) /
-                     sound_name
-                    ).with_suffix('.mp3')
         try:
-            self.__process_sound(work_path, file_path, sound_weight, db_reduction)
-            file = discord.File(file_path)
+            with self.__holding_blobs():
+                measurements = await self.__process_sound(work_path, db_reduction)
+                file_path = measurements.pop('mp3_path')
+
+                replaced = self.__catalog.get_sound(ctx.author.id, guild.id,
+                                                    sound_name)
+                self.__catalog.add_sound(sound_catalog.make_entry(ctx.author.id,
+                                                                  guild.id,
+                                                                  sound_name,
+                                                                  sound_weight,
+                                                                  file_path,
+                                                                  measurements))
+                self.__sound_index.set_sound(ctx.author.id, guild.id,
+                                             sound_name, sound_weight, file_path)
+                if replaced and replaced.mp3_path != str(file_path):
+                    self.__release_blob(replaced.mp3_path)
+
+            file = discord.File(file_path, filename=sound_name + '.mp3')
             await ctx.reply(file=file,
                             content='Successfully added sound {} to server {}'.format(
                                         sound_name, guild.name))
         except Exception as e:
-            await ctx.reply(content='Could not convert audio file: ' + str(e))
+            if isinstance(e, worker_pool.PoolBusyError):
+                await ctx.reply(str(e))
+            else:
+                await ctx.reply(content='Could not convert audio file: ' + str(e))
+
+
+    def __format_loudness(self, rms):
+        if rms is None:
+            return 'unknown'
+        if not rms:
+            return 'silent'
+        return '{:.1f} dBFS'.format(20 * math.log10(rms))
 
 
     def __parse_guild(self, ctx, guild_identifier):
@@ -315,24 +427,209 @@ class SoundManagementCog(commands.Cog):
         return sound_name, sound_weight
 
 
-    def __process_sound(self, sound_path, save_path, sound_weight, db_reduction):
-        sound = pydub.AudioSegment.from_file(sound_path)
-
-        speedup_factor = len(sound) / self.MAX_SOUND_MS
+    async def __report_queue_position(self, ctx, position):
+        await ctx.reply('The bot is busy adding other sounds, yours is number {} in the queue'.format(position))
 
-        if speedup_factor > 1:
-            new_frame_rate = int(sound.frame_rate * speedup_factor)
-            sound = sound._spawn(sound.raw_data,
-                                 overrides={'frame_rate': new_frame_rate})
 
-        #discord takes in 48kHz sound, so preprocess sound files to match
-        sound = sound.set_frame_rate(48000)
-        sound = sound.set_channels(2)
-        sound = sound.set_sample_width(2)
-        sound = sound.fade_in(150)
-        sound = sound.fade_out(150)
-        sound = pydub.effects.normalize(sound)
-        sound = sound - db_reduction
+    async def __process_sound(self, sound_path, db_reduction, bulk=False):
+        """Process an upload in the worker pool and return its measurements
 
-        save_path.parent.mkdir(parents=True, exist_ok=True)
-        sound.export(save_path, tags={'weight':sound_weight})
+        bulk work waits for an idle worker instead of being turned away when
+        the pool is busy.
+        """
+        run_cpu = self.__workers.run_cpu_when_idle if bulk else self.__workers.run_cpu
+        with stats.timed('ingest_ms'):
+            measurements = await run_cpu(sound_processing.process_sound,
+                                         sound_path,
+                                         sound_store.BLOB_ROOT,
+                                         db_reduction)
+        stats.observe('ffmpeg_decode_ms', measurements.pop('decode_ms'),
+                      source='ingest')
+        if not measurements.pop('was_stored'):
+            print('Reused stored sound {}'.format(measurements['content_hash']))
+        return measurements
+
+
+    async def __collect_import(self, attachments, work_dir):
+        """Find the files of an import among its attachments
+
+        Returns ([(file name, async fetch(path))], [skipped zip entry names],
+        manifest text or None). Zip archives are saved whole but their entries
+        are only copied out one at a time, when their turn to be processed
+        comes.
+        """
+        files = []
+        skipped = []
+        manifest = None
+        for i, attachment in enumerate(attachments):
+            if attachment.filename.lower() == self.MANIFEST_NAME:
+                manifest = (await attachment.read()).decode(errors='replace')
+            elif attachment.filename.lower().endswith('.zip'):
+                archive_path = work_dir / 'archive{}.zip'.format(i)
+                await attachment.save(archive_path)
+                (entries,
+                 archive_skipped,
+                 archive_manifest) = await self.__workers.run_io(self.__list_archive,
+                                                                 archive_path)
+                manifest = archive_manifest or manifest
+                skipped += archive_skipped
+                files += [(entry, functools.partial(self.__workers.run_io_when_idle,
+                                                    self.__extract_entry,
+                                                    archive_path, entry))
+                          for entry in entries]
+            elif attachment.content_type and 'audio' in attachment.content_type:
+                if attachment.size > self.MAX_IMPORT_FILE_BYTES:
+                    raise Exception('{} is too large to import'.format(
+                                        attachment.filename))
+                files.append((attachment.filename, attachment.save))
+
+        if not files:
+            raise Exception('No audio files found in the attachments')
+        if len(files) > self.MAX_IMPORT_SOUNDS:
+            raise Exception('At most {} sounds can be imported at once, found {}'.format(
+                                self.MAX_IMPORT_SOUNDS, len(files)))
+        return files, skipped, manifest
+
+
+    def __list_archive(self, archive_path):
+        """Blocking, return (audio entries, other entries, manifest text or None) of a zip"""
+        with zipfile.ZipFile(archive_path) as archive:
+            entries = []
+            skipped = []
+            manifest = None
+            for info in archive.infolist():
+                name = pathlib.PurePosixPath(info.filename).name
+                #skip directories and the resource forks macOS adds
+                if (info.is_dir() or name.startswith('.') or
+                        info.filename.startswith('__MACOSX/')):
+                    continue
+                is_manifest = name.lower() == self.MANIFEST_NAME
+                if not is_manifest and not name.lower().endswith(self.AUDIO_EXTENSIONS):
+                    skipped.append(info.filename)
+                    continue
+                if info.file_size > self.MAX_IMPORT_FILE_BYTES:
+                    raise Exception('{} is too large to import'.format(info.filename))
+                if is_manifest:
+                    manifest = archive.read(info).decode(errors='replace')
+                else:
+                    entries.append(info.filename)
+        return entries, skipped, manifest
+
+
+    def __extract_entry(self, archive_path, entry, path):
+        """Blocking, copy one zip entry to path without unpacking the rest"""
+        with zipfile.ZipFile(archive_path) as archive, \
+                archive.open(entry) as source, open(path, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+
+
+    def __plan_import(self, files, manifest):
+        """Match import files to manifest lines
+
+        Returns ([(sound name, weight, (file name, fetch))], [(name, error)]).
+        """
+        #file name -> (sound name, weight)
+        named = {}
+        for line in (manifest or '').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = shlex.split(line)
+            if len(fields) != 3:
+                raise Exception('Manifest lines must be "file name weight": {}'.format(line))
+            named[fields[0]] = (fields[1], fields[2])
+
+        jobs = []
+        failures = []
+        seen = set()
+        for file_name, fetch in files:
+            base_name = pathlib.PurePosixPath(file_name).name
+            sound_name, sound_weight = named.get(file_name,
+                                                 named.get(base_name,
+                                                           (pathlib.PurePosixPath(
+                                                                base_name).stem, '1')))
+            try:
+                (sound_name, sound_weight) = self.__parse_sound_info(sound_name,
+                                                                     sound_weight)
+                if not sound_name:
+                    raise Exception('Sound name must be alphanumeric + "-" or "_"')
+                if sound_name in seen:
+                    raise Exception('Sound name used twice in this import')
+            except Exception as e:
+                failures.append((file_name, str(e)))
+                continue
+            seen.add(sound_name)
+            jobs.append((sound_name, sound_weight, (file_name, fetch)))
+        return jobs, failures
+
+
+    async def __import_one(self, i, job, work_dir, limit):
+        """Fetch and process one import file, returning its measurements or the error"""
+        _, _, (file_name, fetch) = job
+        work_path = work_dir / 'import{}{}'.format(
+                                   i, pathlib.PurePosixPath(file_name).suffix)
+        async with limit:
+            try:
+                try:
+                    await fetch(work_path)
+                except Exception as e:
+                    print('Could not fetch import file {}: {}'.format(file_name, e))
+                    traceback.print_exc()
+                    return Exception('Could not read file')
+                try:
+                    return await self.__process_sound(work_path, 0, bulk=True)
+                except Exception as e:
+                    #the full ffmpeg error is in the log, it names workspace paths
+                    print('Could not import {}: {}'.format(file_name, e))
+                    traceback.print_exc()
+                    return Exception('Could not convert audio file')
+            finally:
+                work_path.unlink(missing_ok=True)
+
+
+    def __commit_import(self, member_id, guild_id, imported):
+        """Add {sound name: (weight, measurements)} to the catalog and index at once"""
+        replaced = [self.__catalog.get_sound(member_id, guild_id, sound_name)
+                    for sound_name in imported]
+        entries = [sound_catalog.make_entry(member_id,
+                                            guild_id,
+                                            sound_name,
+                                            sound_weight,
+                                            measurements.pop('mp3_path'),
+                                            measurements)
+                   for sound_name, (sound_weight, measurements) in imported.items()]
+
+        self.__catalog.add_sounds(entries)
+        self.__sound_index.update_sounds(member_id, guild_id,
+                                         {entry.name: (entry.weight, entry.mp3_path)
+                                          for entry in entries})
+        for old in replaced:
+            if old:
+                self.__release_blob(old.mp3_path)
+
+
+    @contextlib.contextmanager
+    def __holding_blobs(self):
+        """Keep unreferenced blobs until the ingest in this block has committed
+
+        An ingest can reuse an existing blob in the worker process and only
+        reference it once its catalog row is written, so a blob released in
+        between must not be deleted yet.
+        """
+        self.__ingests += 1
+        try:
+            yield
+        finally:
+            self.__ingests -= 1
+            if not self.__ingests:
+                deferred, self.__deferred_blobs = self.__deferred_blobs, set()
+                for mp3_path in deferred:
+                    self.__release_blob(mp3_path)
+
+
+    def __release_blob(self, mp3_path):
+        """Delete a stored sound once no catalog entry references it"""
+        if self.__ingests:
+            self.__deferred_blobs.add(str(mp3_path))
+        elif self.__catalog.references(mp3_path) == 0:
+            sound_store.delete_blob(mp3_path)
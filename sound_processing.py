@@ -0,0 +1,400 @@
+"""Sound conversion run inside the worker process pool
+
+Everything here has to be a picklable module level function so
+SoundManagementCog can hand it to WorkerPool.run_cpu. pydub is imported by
+the functions that need it, so importing this module for its constants
+does not probe for ffmpeg.
+
+Uploads are streamed through ffmpeg in fixed size chunks rather than decoded
+whole into memory. The speed up and resample to 48kHz are fused into the
+decode, which also measures the peak of every 20ms frame. Those peaks decide
+how much silence to trim from either end and, away from the fades, give the
+normalisation peak without another scan. A second pass applies fades and
+gain to what is kept and measures its loudness envelope. Memory use is
+bounded by the chunk size however long the upload is. The encoded outputs
+are then written from the normalised audio unless an identical sound is
+already stored.
+"""
+
+import hashlib
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+
+import numpy
+
+import envelopes
+import opus_packets
+import pcm_sidecar
+import sound_store
+
+MAX_SOUND_MS = 6000.0
+FADE_MS = 150
+#normalise to just under full scale, as pydub.effects.normalize does
+HEADROOM_DB = 0.1
+
+SAMPLE_RATE = pcm_sidecar.SAMPLE_RATE
+CHANNELS = pcm_sidecar.CHANNELS
+FRAME_BYTES = CHANNELS * pcm_sidecar.SAMPLE_WIDTH
+#half a second, a whole number of 20ms opus frames
+CHUNK_FRAMES = SAMPLE_RATE // 2
+CHUNK_BYTES = CHUNK_FRAMES * FRAME_BYTES
+FADE_FRAMES = FADE_MS * SAMPLE_RATE // 1000
+MAX_FRAMES = int(MAX_SOUND_MS * SAMPLE_RATE // 1000)
+SAMPLES_PER_FRAME = envelopes.SAMPLES_PER_FRAME
+#20ms frames peaking this far below the loudest one are trimmed as silence
+TRIM_DB = 50
+
+
+def process_sound(sound_path, blob_root, db_reduction):
+    """Convert an upload into a stored sound blob
+
+    Silence at either end is trimmed before the speed up is settled, so a
+    long upload that is mostly silence is not sped up needlessly.
+
+    Blobs are named by the hash of their normalised PCM, so an upload that
+    comes out identical to an existing sound reuses its files and skips the
+    mp3 and Opus encoding entirely.
+
+    Returns a dict holding the catalog measurements from pcm_sidecar.measure,
+    the blob's mp3_path, whether it was_stored fresh, and the decode time in
+    ms, which the worker process cannot record into the bot's stats registry
+    itself.
+    """
+    import pydub
+
+    #decoded audio stays in the upload's own workspace
+    raw_path = sound_path.with_name(sound_path.name + '.s16le')
+
+    try:
+        decode_started = time.perf_counter()
+        decode_rate = _decode_rate(sound_path) or SAMPLE_RATE
+        total_frames, frame_peaks = _analyse(sound_path, decode_rate, raw_path)
+
+        #the speed up was planned from the probed duration, which can be
+        #missing or wrong and covers the silence about to be trimmed, so it is
+        #planned again from what was actually decoded and kept
+        start, end = _trim_bounds(frame_peaks, total_frames)
+        kept_seconds = (end - start) / decode_rate
+        kept_rate = _speedup_rate(kept_seconds * 1000)
+        too_long = end - start > MAX_FRAMES
+        #rounding of the two rates alone moves the length by a few samples
+        misplanned = abs(kept_rate - decode_rate) * kept_seconds >= SAMPLES_PER_FRAME
+        if too_long or misplanned:
+            #decode just the kept part again at the speed up it needs
+            total_frames, frame_peaks = _analyse(sound_path, kept_rate, raw_path,
+                                                 start / decode_rate,
+                                                 kept_seconds)
+            start, end = _trim_bounds(frame_peaks, total_frames)
+        decode_ms = (time.perf_counter() - decode_started) * 1000
+
+        peak = _faded_peak(raw_path, frame_peaks, start, end)
+        if peak:
+            target_peak = (2 ** 15) * pydub.utils.db_to_float(-HEADROOM_DB)
+            gain = (target_peak / peak) * pydub.utils.db_to_float(-db_reduction)
+        else:
+            gain = 1.0
+
+        content_hash, envelope = _normalise(raw_path, start, end, gain)
+        mp3_path = sound_store.blob_path(content_hash, blob_root)
+        was_stored = not sound_store.blob_exists(mp3_path)
+        if was_stored:
+            try:
+                _store(raw_path, mp3_path, envelope)
+            except Exception:
+                #an identical upload finishing first leaves the same blob
+                if not sound_store.blob_exists(mp3_path):
+                    raise
+                was_stored = False
+
+    finally:
+        raw_path.unlink(missing_ok=True)
+
+    measurements = pcm_sidecar.measure(pcm_sidecar.open_sidecar(
+                                           pcm_sidecar.sidecar_path(mp3_path)))
+    measurements['mp3_path'] = mp3_path
+    measurements['was_stored'] = was_stored
+    measurements['decode_ms'] = decode_ms
+    return measurements
+
+
+def _decode_rate(sound_path):
+    """Rate to resample the upload to so it plays back in at most 6 seconds
+
+    Decoding at a lower rate and playing the result at 48kHz is the chipmunk
+    speed up. Returns None when the duration cannot be probed. process_sound
+    checks the plan against the decoded length either way.
+    """
+    import pydub
+
+    try:
+        duration_ms = float(pydub.utils.mediainfo(sound_path)['duration']) * 1000
+    except (KeyError, ValueError):
+        return None
+    return _speedup_rate(duration_ms)
+
+
+def _speedup_rate(duration_ms):
+    speedup_factor = duration_ms / MAX_SOUND_MS
+    if speedup_factor > 1:
+        return int(SAMPLE_RATE / speedup_factor)
+    return SAMPLE_RATE
+
+
+def _fade_gains(start, count, total_frames):
+    """Per frame fade multipliers for frames [start, start + count)
+
+    Returns None when no frame is faded.
+    """
+    fading_in = start < FADE_FRAMES
+    fading_out = start + count > total_frames - FADE_FRAMES
+    if not fading_in and not fading_out:
+        return None
+
+    index = numpy.arange(start, start + count, dtype=numpy.float32)
+    gains = numpy.minimum(1.0, index / FADE_FRAMES)
+    if fading_out:
+        gains *= numpy.minimum(1.0, (total_frames - index) / FADE_FRAMES)
+    return gains[:, numpy.newaxis]
+
+
+def _peak(frames, start, total_frames):
+    if not len(frames):
+        return 0.0
+
+    gains = _fade_gains(start, len(frames), total_frames)
+    if gains is None:
+        return float(numpy.abs(frames.astype(numpy.int32)).max())
+    return float(numpy.abs(frames * gains).max())
+
+
+def _analyse(sound_path, decode_rate, raw_path,
+             start_seconds=None, duration_seconds=None):
+    """Decode the upload to raw_path, measuring the peak of every 20ms frame
+
+    start_seconds and duration_seconds limit the decode to part of the upload.
+    Returns (number of frames, uint16 array of 20ms frame peaks).
+    """
+    import pydub
+
+    command = [pydub.AudioSegment.converter, '-v', 'error']
+    if start_seconds:
+        command += ['-ss', '{:.6f}'.format(start_seconds)]
+    command += ['-i', str(sound_path)]
+    if duration_seconds is not None:
+        command += ['-t', '{:.6f}'.format(duration_seconds)]
+    command += ['-f', 's16le', '-acodec', 'pcm_s16le',
+                '-ac', str(CHANNELS), '-ar', str(decode_rate),
+                '-']
+
+    total_frames = 0
+    frame_peaks = []
+    #decoded frames short of a whole 20ms frame
+    pending = numpy.zeros((0, CHANNELS), dtype=numpy.int16)
+    carry = b''
+
+    with tempfile.TemporaryFile() as errors, open(raw_path, 'wb') as raw:
+        ffmpeg = subprocess.Popen(command,
+                                  stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE,
+                                  stderr=errors)
+        try:
+            while True:
+                data = ffmpeg.stdout.read(CHUNK_BYTES)
+                if not data:
+                    break
+
+                data = carry + data if carry else data
+                whole = len(data) - len(data) % FRAME_BYTES
+                carry = data[whole:]
+                raw.write(data[:whole])
+
+                frames = numpy.frombuffer(data[:whole], dtype=numpy.int16)
+                frames = frames.reshape(-1, CHANNELS)
+                total_frames += len(frames)
+                frames = numpy.concatenate((pending, frames))
+                ready = len(frames) - len(frames) % SAMPLES_PER_FRAME
+                frame_peaks.append(envelopes.compute_envelope(
+                                       frames[:ready].reshape(-1))[0])
+                pending = frames[ready:]
+        finally:
+            ffmpeg.stdout.close()
+            ffmpeg.wait()
+
+        if ffmpeg.returncode:
+            errors.seek(0)
+            error = errors.read().decode(errors='replace').strip()
+            raise Exception('Could not decode audio: {}'.format(error or
+                                                                ffmpeg.returncode))
+
+    if len(pending):
+        frame_peaks.append(envelopes.compute_envelope(pending.reshape(-1))[0])
+    return total_frames, _concatenate(frame_peaks)
+
+
+def _trim_bounds(frame_peaks, total_frames):
+    """Range of frames [start, end) left once silence is trimmed from both ends
+
+    A fade length of the silence is kept either side of the audible part, so
+    the fades fall on it rather than on the sound. Audio that is silent
+    throughout is kept whole.
+    """
+    loudest = float(frame_peaks.max()) if len(frame_peaks) else 0.0
+    if not loudest:
+        return 0, total_frames
+
+    audible = numpy.flatnonzero(frame_peaks > loudest * 10 ** (-TRIM_DB / 20))
+    start = max(0, int(audible[0]) * SAMPLES_PER_FRAME - FADE_FRAMES)
+    end = min(total_frames,
+              (int(audible[-1]) + 1) * SAMPLES_PER_FRAME + FADE_FRAMES)
+    return start, end
+
+
+def _faded_peak(raw_path, frame_peaks, start, end):
+    """Peak absolute sample value of frames [start, end) once faded
+
+    20ms frames wholly between the fades keep the peak measured while
+    decoding, so only the faded edges are read back and scanned.
+    """
+    total_frames = end - start
+    #20ms frames [first, last) are clear of both fades
+    first = -(-(start + FADE_FRAMES) // SAMPLES_PER_FRAME)
+    last = (end - FADE_FRAMES) // SAMPLES_PER_FRAME
+    if first >= last:
+        return _edge_peak(raw_path, start, 0, total_frames, total_frames)
+
+    fade_in_end = first * SAMPLES_PER_FRAME - start
+    fade_out_start = last * SAMPLES_PER_FRAME - start
+    return max(float(frame_peaks[first:last].max()),
+               _edge_peak(raw_path, start, 0, fade_in_end, total_frames),
+               _edge_peak(raw_path, start, fade_out_start,
+                          total_frames - fade_out_start, total_frames))
+
+
+def _edge_peak(raw_path, start, offset, count, total_frames):
+    with open(raw_path, 'rb') as raw:
+        raw.seek((start + offset) * FRAME_BYTES)
+        data = raw.read(count * FRAME_BYTES)
+    frames = numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, CHANNELS)
+    return _peak(frames, offset, total_frames)
+
+
+def _normalise(raw_path, start, end, gain):
+    """Apply fades and gain to frames [start, end) of the decoded audio
+
+    The result is written back from the beginning of raw_path, which is then
+    cut to length, so the trimmed silence is dropped in the same pass. Writes
+    never overtake reads since they start no later.
+
+    Returns the hex sha256 of the result, the same hash pcm_sidecar.measure
+    gives for it, and its (peaks, rms) loudness envelope.
+    """
+    total_frames = end - start
+    content_hash = hashlib.sha256()
+    peaks = []
+    rms = []
+
+    with open(raw_path, 'r+b') as raw:
+        position = 0
+        while position < total_frames:
+            raw.seek((start + position) * FRAME_BYTES)
+            data = raw.read(min(CHUNK_FRAMES, total_frames - position) * FRAME_BYTES)
+            if not data:
+                break
+
+            frames = numpy.frombuffer(data, dtype=numpy.int16)
+            frames = frames.reshape(-1, CHANNELS).astype(numpy.float32)
+            gains = _fade_gains(position, len(frames), total_frames)
+            if gains is not None:
+                frames *= gains
+            frames *= gain
+            numpy.rint(frames, out=frames)
+            numpy.clip(frames, -32768, 32767, out=frames)
+            samples = frames.astype(numpy.int16).reshape(-1)
+
+            #chunks are whole 20ms frames, so their envelopes line up
+            chunk_peaks, chunk_rms = envelopes.compute_envelope(samples)
+            peaks.append(chunk_peaks)
+            rms.append(chunk_rms)
+
+            pcm = samples.tobytes()
+            content_hash.update(pcm)
+            raw.seek(position * FRAME_BYTES)
+            raw.write(pcm)
+            position += len(frames)
+
+        raw.truncate(position * FRAME_BYTES)
+
+    return content_hash.hexdigest(), (_concatenate(peaks), _concatenate(rms))
+
+
+def _concatenate(arrays):
+    if not arrays:
+        return numpy.zeros(0, dtype=numpy.uint16)
+    return numpy.concatenate(arrays)
+
+
+def _store(raw_path, mp3_path, envelope):
+    """Write the mp3, PCM sidecar, Opus packets and envelope of a blob
+
+    Every file is written under a unique temporary name and renamed into
+    place, so workers storing the same blob at the same time never share a
+    file or expose a partial one, and whichever renames last wins with
+    identical content. The envelope goes last, as sound_store.blob_exists
+    checks for it.
+    """
+    import pydub
+
+    mp3_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_mp3_path = tempfile.mkstemp(prefix=mp3_path.name + '.',
+                                        suffix='.tmp',
+                                        dir=mp3_path.parent)
+    os.close(fd)
+    tmp_mp3_path = pathlib.Path(tmp_mp3_path)
+    command = [pydub.AudioSegment.converter, '-y', '-v', 'error',
+               '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS),
+               '-i', '-',
+               '-f', 'mp3',
+               str(tmp_mp3_path)]
+
+    sidecar = pcm_sidecar.SidecarWriter(mp3_path)
+    packets = opus_packets.PacketWriter(mp3_path)
+
+    try:
+        with tempfile.TemporaryFile() as errors, open(raw_path, 'rb') as raw:
+            ffmpeg = subprocess.Popen(command,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=errors)
+            try:
+                while True:
+                    pcm = raw.read(CHUNK_BYTES)
+                    if not pcm:
+                        break
+
+                    ffmpeg.stdin.write(pcm)
+                    sidecar.write(pcm)
+                    packets.write(pcm)
+            finally:
+                ffmpeg.stdin.close()
+                ffmpeg.wait()
+
+            if ffmpeg.returncode:
+                errors.seek(0)
+                error = errors.read().decode(errors='replace').strip()
+                raise Exception('Could not encode mp3: {}'.format(error or
+                                                                  ffmpeg.returncode))
+
+        os.replace(tmp_mp3_path, mp3_path)
+
+    except BaseException:
+        sidecar.discard()
+        tmp_mp3_path.unlink(missing_ok=True)
+        raise
+
+    #only once the mp3 exists, so the sidecar is never older than it
+    sidecar.close()
+    packets.close()
+    envelopes.write_envelope(mp3_path, *envelope)
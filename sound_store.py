@@ -0,0 +1,34 @@
+"""Content addressed storage for processed sounds
+
+Processed audio is stored once under the sha256 of its normalised PCM, as
+./sounds/blobs/<first two hex digits>/<hash>.mp3 with its .pcm sidecar,
+.opus packets and .envelope beside it. Catalog entries reference a blob by
+its mp3 path, and a blob is deleted once no entry references it any more.
+"""
+
+import pathlib
+
+import envelopes
+import opus_packets
+import pcm_sidecar
+
+BLOB_ROOT = pathlib.Path('./sounds/blobs')
+
+
+def blob_path(content_hash, blob_root=BLOB_ROOT):
+    return pathlib.Path(blob_root) / content_hash[:2] / (content_hash + '.mp3')
+
+
+def blob_exists(mp3_path):
+    return (mp3_path.is_file() and
+            pcm_sidecar.sidecar_path(mp3_path).is_file() and
+            opus_packets.packets_path(mp3_path).is_file() and
+            envelopes.envelope_path(mp3_path).is_file())
+
+
+def delete_blob(mp3_path):
+    mp3_path = pathlib.Path(mp3_path)
+    mp3_path.unlink(missing_ok=True)
+    pcm_sidecar.delete_sidecar(mp3_path)
+    opus_packets.delete_packets(mp3_path)
+    envelopes.delete_envelope(mp3_path)
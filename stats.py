@@ -0,0 +1,198 @@
+"""Process wide timing histograms for the join and ingest pipelines
+
+Recording a value is a bisect and a few increments, cheap enough for the
+20ms audio loop. Each histogram keeps cumulative bucket counts for the
+Prometheus text file plus a bounded window of recent values for the
+percentiles shown by !stats. A few gauges, such as cache sizes, sit
+alongside them and simply hold their latest value.
+
+Prometheus output is controlled from the environment:
+    LLAMABOT_METRICS_FILE       path of the text file to write (default: off)
+    LLAMABOT_METRICS_INTERVAL   seconds between writes (default: 15)
+"""
+
+import asyncio
+import bisect
+import collections
+import contextlib
+import os
+import pathlib
+import threading
+import time
+import traceback
+
+#bucket upper bounds in milliseconds
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 50, 100, 250, 500,
+              1000, 2500, 5000, 10000, 30000)
+
+
+class RollingHistogram:
+    def __init__(self, window=1024):
+        self.__lock = threading.Lock()
+        self.__bucket_counts = [0] * (len(BUCKETS_MS) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+        self.__recent = collections.deque(maxlen=window)
+
+
+    def observe(self, value_ms):
+        with self.__lock:
+            self.__bucket_counts[bisect.bisect_left(BUCKETS_MS, value_ms)] += 1
+            self.__sum += value_ms
+            self.__count += 1
+            self.__recent.append(value_ms)
+
+
+    @property
+    def count(self):
+        return self.__count
+
+
+    def quantile(self, fraction):
+        """Quantile over the recent window, or None if nothing was recorded"""
+        with self.__lock:
+            recent = sorted(self.__recent)
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(fraction * len(recent)))]
+
+
+    def snapshot(self):
+        """Return (cumulative bucket counts, sum, count) for export"""
+        with self.__lock:
+            counts = list(self.__bucket_counts)
+            total, count = self.__sum, self.__count
+
+        cumulative = []
+        running = 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class Registry:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        #(name, sorted label items) -> RollingHistogram
+        self.__histograms = {}
+        #(name, sorted label items) -> latest value
+        self.__gauges = {}
+
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.__histograms.setdefault(key, RollingHistogram())
+        return histogram
+
+
+    def observe(self, name, value_ms, **labels):
+        self.histogram(name, **labels).observe(value_ms)
+
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.__lock:
+            self.__gauges[key] = value
+
+
+    def gauges(self):
+        """Return [(name, {label: value}, value)] sorted by name and labels"""
+        with self.__lock:
+            entries = sorted(self.__gauges.items())
+        return [(name, dict(labels), value) for (name, labels), value in entries]
+
+
+    def items(self):
+        """Return [(name, {label: value}, histogram)] sorted by name and labels"""
+        with self.__lock:
+            entries = sorted(self.__histograms.items())
+        return [(name, dict(labels), histogram)
+                for (name, labels), histogram in entries]
+
+
+    def render_prometheus(self):
+        lines = []
+        typed = set()
+        for name, labels, histogram in self.items():
+            metric = 'llamabot_' + name
+            if metric not in typed:
+                lines.append('# TYPE {} histogram'.format(metric))
+                typed.add(metric)
+
+            cumulative, total, count = histogram.snapshot()
+            bounds = [str(b) for b in BUCKETS_MS] + ['+Inf']
+            for bound, bucket_count in zip(bounds, cumulative):
+                lines.append('{}_bucket{} {}'.format(
+                                 metric, _labels(labels, le=bound), bucket_count))
+            lines.append('{}_sum{} {}'.format(metric, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(metric, _labels(labels), count))
+
+        for name, labels, value in self.gauges():
+            metric = 'llamabot_' + name
+            if metric not in typed:
+                lines.append('# TYPE {} gauge'.format(metric))
+                typed.add(metric)
+            lines.append('{}{} {}'.format(metric, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, path):
+        path = pathlib.Path(path)
+        tmp_path = path.with_name(path.name + '.tmp')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v)
+                          for k, v in sorted(labels.items())) + '}'
+
+
+REGISTRY = Registry()
+
+
+def observe(name, value_ms, **labels):
+    REGISTRY.observe(name, value_ms, **labels)
+
+
+def set_gauge(name, value, **labels):
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def since_ms(started):
+    """Milliseconds elapsed since a time.perf_counter() reading"""
+    return (time.perf_counter() - started) * 1000
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, since_ms(started), **labels)
+
+
+async def write_periodically(path=None, interval=None):
+    """Rewrite the Prometheus text file forever, for running as a task"""
+    path = path or os.getenv('LLAMABOT_METRICS_FILE')
+    interval = interval or float(os.getenv('LLAMABOT_METRICS_INTERVAL', 15))
+    if not path:
+        return
+
+    while True:
+        try:
+            REGISTRY.write_prometheus(path)
+        except Exception as e:
+            traceback.print_exc()
+            print('Could not write metrics to {}: {}'.format(path, e))
+        await asyncio.sleep(interval)
@@ -1,21 +1,52 @@
 
 import asyncio
+import collections
 import functools
-import pathlib
-import random
+import os
+import time
 import traceback
 
 import discord
 from discord.ext import commands
-import pydub
 
+import intro_scheduler
+import join_batcher
 import mixed_audio
+import sound_cache
+import stats
+import worker_pool
 
 
 class VoiceCog(commands.Cog):
-    def __init__(self, bot):
+    def __init__(self, bot, sound_index, workers, audio_workers=None):
         self.__bot = bot
-        self.__upcoming_duties = {}
+        self.__sound_index = sound_index
+        self.__workers = workers
+        #mix in worker processes instead of the player threads when enabled
+        self.__audio_workers = (audio_workers if audio_workers and
+                                audio_workers.enabled else None)
+        #batches and intro advances both move the voice client, so they take
+        #turns per guild
+        guild_locks = collections.defaultdict(asyncio.Lock)
+        self.__intros = intro_scheduler.IntroScheduler(self.__play_queued_intros,
+                                                       self.__finish_intros,
+                                                       locks=guild_locks)
+        self.__joins = join_batcher.JoinBatcher(self.__play_joins,
+                                                locks=guild_locks)
+        #seconds to stay connected after the last sound, 0 to leave right away
+        self.__linger_seconds = float(os.getenv('LLAMABOT_LINGER_SECONDS', 0))
+        self.__idle_timers = {}
+        #frames mixed ahead of playback, 0 to mix inside read()
+        self.__read_ahead = int(os.getenv('LLAMABOT_READ_AHEAD_FRAMES', 0))
+        #sounds mixed at once per guild, and what happens to one more
+        self.__max_voices = int(os.getenv('LLAMABOT_MAX_VOICES', 8)) or None
+        self.__voice_overflow = os.getenv('LLAMABOT_VOICE_OVERFLOW', 'queue')
+        #decoded sounds shared by every guild's source
+        self.__sounds = sound_cache.SoundCache()
+        #load a member's sounds while their join is being debounced
+        #pointless when the audio workers load sounds into their own caches
+        self.__prewarm = (os.getenv('LLAMABOT_PREWARM_SOUNDS', '1') == '1' and
+                          not self.__audio_workers)
 
         @bot.event
         async def on_voice_state_update(member, before, after):
@@ -25,42 +56,103 @@ class VoiceCog(commands.Cog):
                 print('adfadf')
                 return
 
-            #options for when a user joins a channel:
-            #   * Bot not in any channel - join the channel and play a sound
-            #   * Bot already in the channel - add the sound to the source
-            #   * Bot in a another channel - queue up join noises for the new channel
+            #a lingering bot leaves as soon as it is alone in its channel
+            if self.__linger_seconds and before.channel != after.channel:
+                voice_client = self.__get_voice_client_by_guild(member.guild)
+                if (voice_client and voice_client.channel == before.channel and
+                        all(m.bot for m in before.channel.members)):
+                    self.__cancel_idle_timer(member.guild)
+                    self.__intros.discard(member.guild)
+                    await voice_client.disconnect(force=False)
+
+            #members leaving before their batch is played get no sound
+            if before.channel and before.channel != after.channel:
+                self.__joins.discard(member.guild, member)
 
             #user entering a channel
             if after.channel and after.channel != before.channel:
-                guild = member.guild
-                channel = after.channel
-                sound_path = self.__get_sound_path(member, guild)
-                if sound_path:
-                    voice_client = self.__get_voice_client_by_guild(guild)
-                    #bot not in any channel
-                    if not voice_client:
-                        #connect to the channel and start playing a sound
-                        voice_client = await channel.connect()
-                        source = mixed_audio.MixedAudio(sound_path)
-                        after = functools.partial(self.__post_sound_cleanup,
-                                                  voice_client)
-                        voice_client.play(source, after=after)
-                    #bot already in this channel
-                    elif voice_client.channel == channel:
-                        voice_client.source.add_sound(sound_path)
-                    #bot in another channel
-                    else:
-                        if guild not in self.__upcoming_duties:
-                            self.__upcoming_duties[guild] = {}
-                        if channel in self.__upcoming_duties[guild]:
-                            self.__upcoming_duties[guild][channel].append(sound_path)
-                        else:
-                            self.__upcoming_duties[guild][channel] = [sound_path]
+                self.__joins.add(member.guild, after.channel, member)
+                if self.__prewarm:
+                    self.__prewarm_sounds(member, member.guild)
 
           except Exception as e:
             print(e)
 
 
+    async def preload_sounds(self, sound_paths):
+        """Fill the shared sound cache at startup, as far as its budget allows"""
+        if not self.__prewarm:
+            return
+        await self.__workers.run_io(self.__sounds.prewarm, sound_paths, True)
+
+
+    async def __play_joins(self, guild, channel, members, join_started):
+        """Play the sounds of a batch of members who joined channel together"""
+        #joins right after startup wait for the index to finish loading
+        if not self.__sound_index.loaded:
+            await self.__sound_index.wait_loaded()
+
+        select_started = time.perf_counter()
+        sounds = []
+        for member in members:
+            #skip anyone who left again while the batch was collected
+            if not member.voice or member.voice.channel != channel:
+                continue
+            sound_path = self.__get_sound_path(member, guild)
+            if sound_path:
+                sounds.append((member, sound_path))
+        stats.observe('join_stage_ms', stats.since_ms(select_started),
+                      stage='select', guild=guild.id)
+        if not sounds:
+            return
+        sound_paths = [sound_path for _, sound_path in sounds]
+
+        #options for when a batch joins a channel:
+        #   * Bot not in any channel - join the channel and play the sounds
+        #   * Bot already in the channel - add the sounds to the source
+        #   * Bot idling in another channel - move there and play the sounds
+        #   * Bot in a another channel - queue up join noises for the new channel
+        voice_client = self.__get_voice_client_by_guild(guild)
+        #bot not in any channel
+        if not voice_client:
+            #connect to the channel and start playing the sounds
+            #map the sounds while the voice handshake runs
+            source_task = asyncio.create_task(
+                self.__workers.run_voice(self.__build_source,
+                                         guild,
+                                         sound_paths))
+            try:
+                with stats.timed('join_stage_ms',
+                                 stage='connect', guild=guild.id):
+                    voice_client = await channel.connect()
+            except BaseException:
+                #nothing is going to play the source
+                source_task.add_done_callback(self.__cleanup_unplayed_source)
+                raise
+            try:
+                source = await source_task
+            except BaseException:
+                #a client left connected without a player would take every
+                #later join to this channel down with it
+                await voice_client.disconnect(force=True)
+                raise
+            source.mark_join(join_started, guild.id)
+            voice_client.play(source,
+                              after=self.__after_callback(voice_client))
+        #bot already in this channel
+        elif voice_client.channel == channel:
+            await self.__add_sounds(voice_client, sound_paths)
+        #bot lingering silently in another channel
+        elif voice_client.is_paused():
+            await self.__play_next_channel_intros(voice_client,
+                                                  channel,
+                                                  sound_paths)
+        #bot in another channel
+        else:
+            for member, sound_path in sounds:
+                self.__intros.add(guild, channel, member, sound_path)
+
+
     @commands.command(brief='Forces bot to leave the server')
     async def leave(self, ctx):
         await ctx.voice_client.disconnect()
@@ -69,24 +161,162 @@ class VoiceCog(commands.Cog):
     async def __play_next_channel_intros(self, voice_client, channel, sounds):
         await voice_client.move_to(channel)
 
-        source = mixed_audio.MixedAudio(sounds[0])
-        for sound in sounds[1:]:
+        if self.__linger_seconds:
+            await self.__add_sounds(voice_client, sounds)
+            return
+
+        await self.__play_new_source(voice_client, sounds)
+
+
+    async def __play_new_source(self, voice_client, sounds):
+        source = await self.__workers.run_voice(self.__build_source,
+                                                voice_client.guild,
+                                                sounds)
+        voice_client.play(source, after=self.__after_callback(voice_client))
+
+
+    async def __add_sounds(self, voice_client, sounds):
+        """Mix sounds into the running source, waking it if it is lingering"""
+        source = voice_client.source
+        if source is None or not (voice_client.is_playing() or
+                                  voice_client.is_paused()):
+            #the last source already ended, so there is nothing to mix into
+            await self.__play_new_source(voice_client, sounds)
+            return
+
+        for sound in sounds:
+            await self.__workers.run_voice(source.add_sound, sound)
+
+        self.__cancel_idle_timer(voice_client.guild)
+        if voice_client.is_paused():
+            voice_client.resume()
+
+
+    def __build_source(self, guild, sounds):
+        started = time.perf_counter()
+        on_idle = None
+        if self.__linger_seconds:
+            on_idle = functools.partial(self.__bot.loop.call_soon_threadsafe,
+                                        self.__on_source_idle,
+                                        guild)
+
+        if self.__audio_workers:
+            source = self.__audio_workers.create_source(guild.id,
+                                                        linger=bool(on_idle),
+                                                        on_idle=on_idle,
+                                                        max_voices=self.__max_voices,
+                                                        overflow=self.__voice_overflow)
+        else:
+            source = mixed_audio.MixedAudio(linger=bool(on_idle),
+                                            on_idle=on_idle,
+                                            read_ahead=self.__read_ahead,
+                                            max_voices=self.__max_voices,
+                                            overflow=self.__voice_overflow,
+                                            cache=self.__sounds,
+                                            guild_id=guild.id)
+
+        for sound in sounds:
             source.add_sound(sound)
+        stats.observe('join_stage_ms', stats.since_ms(started),
+                      stage='decode', guild=guild.id)
+        return source
+
+
+    def __cleanup_unplayed_source(self, source_task):
+        if not source_task.cancelled() and source_task.exception() is None:
+            source_task.result().cleanup()
+
+
+    def __after_callback(self, voice_client):
+        if self.__linger_seconds:
+            return functools.partial(self.__post_linger_cleanup,
+                                     voice_client)
+        return functools.partial(self.__post_sound_cleanup,
+                                 voice_client)
+
 
-        after = functools.partial(self.__post_sound_cleanup,
-                                  voice_client)
-        voice_client.play(source, after=after)
+    def __on_source_idle(self, guild):
+        """Called on the event loop when a lingering source runs out of sound"""
+        voice_client = self.__get_voice_client_by_guild(guild)
+        if (not voice_client or not voice_client.source or
+                not voice_client.source.is_idle()):
+            return
+
+        if self.__intros.has_pending(guild):
+            self.__intros.source_finished(guild)
+        else:
+            self.__go_idle(voice_client)
+
+
+    def __go_idle(self, voice_client):
+        """Stay connected but stop sending until the next join or timeout"""
+        voice_client.pause()
+        self.__cancel_idle_timer(voice_client.guild)
+        self.__idle_timers[voice_client.guild] = self.__bot.loop.call_later(
+                                                     self.__linger_seconds,
+                                                     self.__disconnect_idle,
+                                                     voice_client.guild)
+
+
+    async def __play_queued_intros(self, guild, channel, sounds):
+        voice_client = self.__get_voice_client_by_guild(guild)
+        if voice_client:
+            await self.__play_next_channel_intros(voice_client, channel, sounds)
+        else:
+            source = await self.__workers.run_voice(self.__build_source,
+                                                    guild,
+                                                    sounds)
+            try:
+                voice_client = await channel.connect()
+            except BaseException:
+                source.cleanup()
+                raise
+            voice_client.play(source, after=self.__after_callback(voice_client))
+
+
+    async def __finish_intros(self, guild):
+        voice_client = self.__get_voice_client_by_guild(guild)
+        if not voice_client:
+            return
+        if self.__linger_seconds:
+            if voice_client.source and voice_client.source.is_idle():
+                self.__go_idle(voice_client)
+        elif not voice_client.is_playing():
+            #a source started since this one finished disconnects when it ends
+            await voice_client.disconnect(force=False)
+
+
+    def __disconnect_idle(self, guild):
+        self.__idle_timers.pop(guild, None)
+        voice_client = self.__get_voice_client_by_guild(guild)
+        if voice_client and voice_client.is_paused():
+            asyncio.create_task(voice_client.disconnect(force=False))
+
+
+    def __cancel_idle_timer(self, guild):
+        timer = self.__idle_timers.pop(guild, None)
+        if timer:
+            timer.cancel()
+
+
+    def __prewarm_sounds(self, member, guild):
+        sound_paths = [sound_path for _, sound_path in
+                       self.__sound_index.sounds(member.id, guild.id).values()]
+        if sound_paths:
+            asyncio.create_task(self.__prewarm_in_background(sound_paths))
+
+
+    async def __prewarm_in_background(self, sound_paths):
+        try:
+            await self.__workers.run_io(self.__sounds.prewarm, sound_paths)
+        except worker_pool.PoolBusyError:
+            #only an optimisation, the join itself still loads its sound
+            pass
 
 
     def __get_sound_path(self, member, guild):
         try:
-            sounds = pathlib.Path('./sounds') / str(member.id) / str(guild.id)
-            if sounds.exists():
-                sound_choices = []
-                for sound in sounds.iterdir():
-                    weight = int(pydub.utils.mediainfo(sound)['TAG']['weight'])
-                    sound_choices += [sound] * weight
-                return random.choice(sound_choices)
+            return self.__sound_index.choose(member.id, guild.id)
 
         except Exception as e:
             traceback.print_exc()
@@ -96,32 +326,21 @@ class VoiceCog(commands.Cog):
 
 
     def __get_voice_client_by_guild(self, guild):
-        for voice_client in self.__bot.voice_clients:
-            if voice_client.guild == guild:
-                return voice_client
-        return None
+        #discord keeps voice clients keyed by guild id, no need to scan
+        return guild.voice_client
 
 
     def __post_sound_cleanup(self, voice_client, error):
-        try:
-            if (voice_client.guild not in self.__upcoming_duties or
-                    not self.__upcoming_duties[voice_client.guild]):
-                fut = asyncio.run_coroutine_threadsafe(
-                            voice_client.disconnect(force=False),
-                            self.__bot.loop)
-            else:
-                channel, sounds = self.__upcoming_duties[voice_client.guild].popitem()
-                fut = asyncio.run_coroutine_threadsafe(
-                            self.__play_next_channel_intros(voice_client,
-                                                            channel,
-                                                            sounds),
-                            self.__bot.loop)
-            fut.result()
-
-        except Exception as e:
-            traceback.print_exc()
-            print(e)
-            raise
-
+        """Runs on the audio player thread, so only hands off to the event loop"""
+        if error:
+            print(error)
+        self.__bot.loop.call_soon_threadsafe(self.__intros.source_finished,
+                                             voice_client.guild)
 
 
+    def __post_linger_cleanup(self, voice_client, error):
+        """A lingering source only stops when the voice client disconnects"""
+        if error:
+            print(error)
+        self.__bot.loop.call_soon_threadsafe(self.__cancel_idle_timer,
+                                             voice_client.guild)
@@ -0,0 +1,156 @@
+"""Executors that keep blocking work off the bot's event loop
+
+CPU heavy jobs (decoding, resampling, encoding) go to a process pool and
+blocking I/O (downloads, file reads, subprocess waits) to a thread pool. Each
+of those only accepts a bounded number of outstanding jobs so a burst of
+requests is turned away with a clear message instead of queueing without
+limit. Bulk work such as imports can instead wait for an idle worker, which
+leaves the queue free for interactive requests. Voice playback work has a thread pool of its own that queues instead,
+since a join cannot be retried by whoever triggered it, and its jobs are
+short file maps rather than user requested work.
+
+Sizes are read from the environment:
+    LLAMABOT_CPU_WORKERS     processes for CPU work (default: cpu count)
+    LLAMABOT_IO_WORKERS      threads for blocking I/O (default: 8)
+    LLAMABOT_MAX_QUEUED      jobs allowed to wait per pool beyond the workers
+                             (default: 16)
+    LLAMABOT_VOICE_WORKERS   threads for loading sounds to play (default: 4)
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import os
+import traceback
+
+
+class PoolBusyError(Exception):
+    pass
+
+
+class _BoundedExecutor:
+    def __init__(self, name, executor, workers, max_queued):
+        """max_queued of None queues without limit and never raises PoolBusyError"""
+        self.__name = name
+        self.__executor = executor
+        self.__workers = workers
+        self.__limit = workers + max_queued if max_queued is not None else None
+        self.__outstanding = 0
+        #futures of run_when_idle callers in arrival order
+        self.__idle_waiters = collections.deque()
+
+
+    @property
+    def outstanding(self):
+        return self.__outstanding
+
+
+    async def run(self, func, *args, **kwargs):
+        if self.__limit is not None and self.__outstanding >= self.__limit:
+            error = 'The bot is busy with {} {} jobs, try again shortly'.format(
+                        self.__outstanding, self.__name)
+            raise PoolBusyError(error)
+
+        self.__outstanding += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                        self.__executor, functools.partial(func, *args, **kwargs))
+        except Exception as e:
+            print('{} job {} failed: {}'.format(
+                      self.__name, getattr(func, '__name__', func), e))
+            traceback.print_exc()
+            raise
+        finally:
+            self.__outstanding -= 1
+            self.__wake_idle_waiter()
+
+
+    async def run_when_idle(self, func, *args, **kwargs):
+        """Like run, but wait for an idle worker instead of raising PoolBusyError"""
+        while self.__outstanding >= self.__workers:
+            waiter = asyncio.get_running_loop().create_future()
+            self.__idle_waiters.append(waiter)
+            try:
+                await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    #woken just before we gave up, pass the wake up on
+                    self.__wake_idle_waiter()
+                elif waiter in self.__idle_waiters:
+                    self.__idle_waiters.remove(waiter)
+                raise
+        return await self.run(func, *args, **kwargs)
+
+
+    def __wake_idle_waiter(self):
+        while self.__idle_waiters:
+            waiter = self.__idle_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WorkerPool:
+    def __init__(self, cpu_workers=None, io_workers=None, max_queued=None,
+                 voice_workers=None):
+        cpu_workers = cpu_workers or int(os.getenv('LLAMABOT_CPU_WORKERS',
+                                                   os.cpu_count() or 1))
+        io_workers = io_workers or int(os.getenv('LLAMABOT_IO_WORKERS', 8))
+        voice_workers = voice_workers or int(os.getenv('LLAMABOT_VOICE_WORKERS', 4))
+        if max_queued is None:
+            max_queued = int(os.getenv('LLAMABOT_MAX_QUEUED', 16))
+
+        self.__cpu = _BoundedExecutor(
+            'processing',
+            concurrent.futures.ProcessPoolExecutor(cpu_workers),
+            cpu_workers,
+            max_queued)
+        self.__io = _BoundedExecutor(
+            'I/O',
+            concurrent.futures.ThreadPoolExecutor(io_workers,
+                                                  thread_name_prefix='llamabot-io'),
+            io_workers,
+            max_queued)
+        self.__voice = _BoundedExecutor(
+            'voice',
+            concurrent.futures.ThreadPoolExecutor(voice_workers,
+                                                  thread_name_prefix='llamabot-voice'),
+            voice_workers,
+            None)
+
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """Run a picklable module level function in the process pool"""
+        return await self.__cpu.run(func, *args, **kwargs)
+
+
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking callable in the thread pool"""
+        return await self.__io.run(func, *args, **kwargs)
+
+
+    async def run_cpu_when_idle(self, func, *args, **kwargs):
+        """Run in the process pool once a worker is idle, for bulk work"""
+        return await self.__cpu.run_when_idle(func, *args, **kwargs)
+
+
+    async def run_io_when_idle(self, func, *args, **kwargs):
+        """Run in the thread pool once a worker is idle, for bulk work"""
+        return await self.__io.run_when_idle(func, *args, **kwargs)
+
+
+    async def run_voice(self, func, *args, **kwargs):
+        """Run blocking playback work in the voice thread pool, which never refuses"""
+        return await self.__voice.run(func, *args, **kwargs)
+
+
+    def shutdown(self):
+        self.__cpu.shutdown()
+        self.__io.shutdown()
+        self.__voice.shutdown()
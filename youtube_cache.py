@@ -0,0 +1,201 @@
+"""On-disk cache of downloaded YouTube audio streams
+
+The best audio stream of a video is downloaded whole the first time any clip
+of it is requested and kept under ./cache/youtube. Every clip, whether of
+the same range or another one, is then cut from the cached stream with
+ffmpeg without going back to the extractor. The cache is capped in size and
+evicts the least recently used video first.
+
+Downloading goes through a downloader object with two methods, so yt_dlp can
+be swapped for a fake one:
+    video_id(url)               cache key for url without any network access,
+                                or None if it cannot be worked out offline
+    download(url, directory)    download the whole stream into directory,
+                                returning (cache key, path of the file)
+
+The size limit is read from the environment:
+    LLAMABOT_YOUTUBE_CACHE_MB   total size of cached streams (default: 1024)
+"""
+
+import collections
+import os
+import pathlib
+import subprocess
+import tempfile
+import threading
+
+
+class YtDlpDownloader:
+    def __init__(self, yt_opts=None):
+        self.__yt_opts = yt_opts or {}
+
+
+    def video_id(self, url):
+        from yt_dlp.extractor import gen_extractor_classes
+
+        for extractor in gen_extractor_classes():
+            if extractor.suitable(url):
+                video_id = extractor.get_temp_id(url)
+                if video_id is None:
+                    return None
+                return '{}-{}'.format(extractor.ie_key(), video_id)
+        return None
+
+
+    def download(self, url, directory):
+        import yt_dlp
+
+        yt_opts = dict(self.__yt_opts,
+                       format='ba', #best audio only format
+                       outtmpl=str(pathlib.Path(directory) / 'stream.%(ext)s'),
+                       noplaylist=True)
+        with yt_dlp.YoutubeDL(yt_opts) as ydl:
+            info_dict = ydl.extract_info(url, download=True)
+            key = '{}-{}'.format(info_dict['extractor_key'], info_dict['id'])
+            return key, pathlib.Path(ydl.prepare_filename(info_dict))
+
+
+class YoutubeCache:
+    def __init__(self, cache_root='./cache/youtube', max_bytes=None, downloader=None):
+        self.__root = pathlib.Path(cache_root)
+        self.__max_bytes = max_bytes or int(
+            float(os.getenv('LLAMABOT_YOUTUBE_CACHE_MB', 1024)) * 1024 * 1024)
+        self.__downloader = downloader or YtDlpDownloader()
+
+        self.__lock = threading.Lock()
+        #cache key -> (path, size) with the least recently used first
+        self.__entries = collections.OrderedDict()
+        #cache key -> lock held while that video downloads
+        self.__downloads = {}
+        #cache key -> number of clips being cut from it right now
+        self.__pinned = collections.Counter()
+
+        self.__root.mkdir(parents=True, exist_ok=True)
+        self.__load()
+
+
+    @property
+    def size(self):
+        with self.__lock:
+            return sum(size for _, size in self.__entries.values())
+
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+
+    def fetch_clip(self, url, start_time, end_time, clip_path):
+        """Cut start_time to end_time seconds of url's audio into clip_path
+
+        Blocking, run it on the I/O pool. The stream is only downloaded when
+        it is not cached yet, and a video requested by several users at once
+        is only downloaded once. Returns True if the cache was hit.
+        """
+        key = self.__downloader.video_id(url)
+        hit = key is not None and self.__pin(key)
+        if not hit:
+            key = self.__download(url, key)
+
+        try:
+            self.__cut(self.__entries[key][0], start_time, end_time, clip_path)
+        finally:
+            self.__unpin(key)
+        return hit
+
+
+    def __load(self):
+        #start from whatever previous runs left behind, oldest use first
+        streams = [path for path in self.__root.iterdir()
+                   if path.is_file() and not path.name.startswith('.')]
+        streams.sort(key=lambda path: path.stat().st_mtime)
+        for path in streams:
+            self.__entries[path.stem] = (path, path.stat().st_size)
+
+
+    def __pin(self, key):
+        """Mark a cached video as in use, returning False if it is not cached"""
+        with self.__lock:
+            if key not in self.__entries:
+                return False
+            self.__entries.move_to_end(key)
+            self.__pinned[key] += 1
+            path = self.__entries[key][0]
+
+        #so the order survives a restart
+        path.touch()
+        return True
+
+
+    def __unpin(self, key):
+        with self.__lock:
+            self.__pinned[key] -= 1
+            if self.__pinned[key] <= 0:
+                del self.__pinned[key]
+            self.__evict()
+
+
+    def __download(self, url, key):
+        """Download url into the cache and return its key, pinned"""
+        if key is not None:
+            with self.__lock:
+                download_lock = self.__downloads.setdefault(key, threading.Lock())
+            with download_lock:
+                #someone else may have finished downloading it meanwhile
+                if self.__pin(key):
+                    return key
+                try:
+                    return self.__download_uncached(url)
+                finally:
+                    with self.__lock:
+                        self.__downloads.pop(key, None)
+
+        return self.__download_uncached(url)
+
+
+    def __download_uncached(self, url):
+        with tempfile.TemporaryDirectory(prefix='.download-', dir=self.__root) as directory:
+            key, path = self.__downloader.download(url, directory)
+            cached_path = self.__root / (key + path.suffix)
+            os.replace(path, cached_path)
+
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old and old[0] != cached_path:
+                old[0].unlink(missing_ok=True)
+            self.__entries[key] = (cached_path, cached_path.stat().st_size)
+            self.__pinned[key] += 1
+        return key
+
+
+    def __evict(self):
+        #called with the lock held
+        total = sum(size for _, size in self.__entries.values())
+        for key in list(self.__entries):
+            if total <= self.__max_bytes:
+                break
+            if self.__pinned[key]:
+                continue
+
+            path, size = self.__entries.pop(key)
+            path.unlink(missing_ok=True)
+            total -= size
+            print('Evicted {} from the youtube cache'.format(key))
+
+
+    def __cut(self, stream_path, start_time, end_time, clip_path):
+        import pydub
+
+        command = [pydub.AudioSegment.converter, '-y', '-v', 'error',
+                   '-ss', str(start_time),
+                   '-i', str(stream_path),
+                   '-t', str(end_time - start_time),
+                   '-vn', '-acodec', 'pcm_s16le',
+                   str(clip_path)]
+        result = subprocess.run(command,
+                                stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE)
+        if result.returncode:
+            error = result.stderr.decode(errors='replace').strip()
+            raise Exception('Could not cut clip: {}'.format(error or result.returncode))